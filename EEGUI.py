@@ -3,6 +3,8 @@ from pyqtgraph.Qt import QtWidgets, QtCore, QtGui
 from astropy.io import fits
 import numpy as np
 
+from imgAnalysis import EncircledEnergy, BackgroundModel, image_centroid
+
 
 # Start Qt app
 app = pg.mkQApp("Image Display")
@@ -31,6 +33,19 @@ class MainWindow(QtWidgets.QMainWindow):
         self.og_im_data = self.main_imi.image
         self.total_counts = 0
 
+        # Encircled energy curve and radial profile about the EE ROI centre,
+        # recomputed only when the image or the centre changes. The curve is
+        # cut off at twice the ROI radius, so dragging the ROI is O(ROI).
+        self.ee = EncircledEnergy()
+        self.ee_min_radius = 32
+        self.ee_stale = True
+
+        # Background model fitted to the background ROI. The image is never
+        # rewritten, EE is corrected analytically and the display levels moved.
+        self.background = None
+        self.ee_energy = None  # Background-corrected EE curve and radial profile
+        self.ee_profile = None
+
         # Create HistogramLUTItem
         self.hist = pg.HistogramLUTItem()
         self.hist.autoHistogramRange()
@@ -60,6 +75,11 @@ class MainWindow(QtWidgets.QMainWindow):
         self.bg_set_button = pg.QtWidgets.QPushButton("Set Background")
         self.bg_set_button.pressed.connect(self.set_background)
 
+        # Create Background Model Selector (constant level or plane)
+        self.bg_model_selector = pg.QtWidgets.QComboBox()
+        self.bg_model_selector.addItems(["Constant", "Plane"])
+        self.bg_model_selector.currentTextChanged.connect(self.bg_model_changed)
+
 
         # Add Items to p1
         self.p1.addItem(self.hist)
@@ -94,14 +114,34 @@ class MainWindow(QtWidgets.QMainWindow):
         # Percent Enclosed
         self.pc_enc_label = pg.QtWidgets.QLabel()
 
+        # Background Level at the EE ROI Centre
+        self.bg_label = pg.QtWidgets.QLabel("None")
+
 
         # Add Rows to Data Panel Form
         dp_form_layout.addRow("ROI Radius: ", self.dp_roi_size)
         dp_form_layout.addRow("Energy Enclosed: ", self.pc_enc_label)
+        dp_form_layout.addRow("Background: ", self.bg_label)
+
+        # EE Curve and Radial Profile Plots, with the EE ROI radius marked
+        self.ee_plot = pg.PlotWidget(title="Encircled Energy")
+        self.ee_plot.setLabel("bottom", "Radius", units="px")
+        self.ee_plot.setLabel("left", "Fraction")
+        self.ee_curve = self.ee_plot.plot(pen=(255, 0, 0))
+        self.ee_radius_line = pg.InfiniteLine(angle=90)
+        self.ee_plot.addItem(self.ee_radius_line)
+        self.profile_plot = pg.PlotWidget(title="Radial Profile")
+        self.profile_plot.setLabel("bottom", "Radius", units="px")
+        self.profile_plot.setLabel("left", "Mean Counts")
+        self.profile_curve = self.profile_plot.plot(pen=(0, 128, 255))
+        self.profile_radius_line = pg.InfiniteLine(angle=90)
+        self.profile_plot.addItem(self.profile_radius_line)
 
         # Arrange Widgets in Data Panel
         self.dp1grid.addWidget(dp_text, 1)
         self.dp1grid.addWidget(dp_form, 10)
+        self.dp1grid.addWidget(self.ee_plot, 20)
+        self.dp1grid.addWidget(self.profile_plot, 20)
 
 
 
@@ -119,6 +159,10 @@ class MainWindow(QtWidgets.QMainWindow):
         self.addToolBar(QtCore.Qt.TopToolBarArea, self.toolbar)
         self.toolbar.addWidget(file_button)
         self.toolbar.addWidget(self.bg_set_button)
+        self.toolbar.addWidget(self.bg_model_selector)
+        export_button = QtWidgets.QPushButton("Export EE")
+        export_button.clicked.connect(self.export_ee)
+        self.toolbar.addWidget(export_button)
 
 
     
@@ -131,17 +175,23 @@ class MainWindow(QtWidgets.QMainWindow):
         self.og_im_data = data #Set as OG Image
         self.hist.setImageItem(self.main_imi) # Set as Hist Image
 
+        # New image, no background yet
+        self.background = None
+        self.bg_label.setText("None")
+        self.bg_set_button.setVisible(True)
+
         x,y = np.shape(data) 
 
 
 
         # ROI parameters
         roi_size = 100
-        roi_pos = ((y - roi_size) / 2, (x - roi_size) / 2)  # Centered position
+        cx, cy = image_centroid(data)
+        roi_pos = (cx - roi_size / 2, cy - roi_size / 2)  # Centered on the centroid
         roi_bounds = pg.QtCore.QRectF(pg.QtCore.QPoint(0, 0), pg.QtCore.QPoint(y, x))
         
 
-        # ROI centered in image
+        # ROI centered on the image centroid
         self.ee_roi.setPos(roi_pos)
         self.bg_roi.setPos((y - self.bg_roi.size().y(), x-self.bg_roi.size().y()))
 
@@ -155,32 +205,70 @@ class MainWindow(QtWidgets.QMainWindow):
 
 
     def main_image_changed(self):
-        print("change")
-        self.total_counts = np.sum(self.main_imi.image)
+        # The EE curve (and total counts) is recomputed on the next calculate_ee
+        self.ee_stale = True
     
     def set_background(self):
         '''
-        Set the background count when button is pressed, remove button.
+        Fit the background model to bg_roi when button is pressed, remove button.
         '''
-        bg_region = self.bg_roi.getArrayRegion(self.main_imi.image, self.main_imi) # Get background region from bg_roi
-        avg_bg_count = np.average(bg_region)
-        # Adjust image data and display operational data
-        bg_rem_data = self.og_im_data - avg_bg_count
-        bg_rem_data[bg_rem_data<0] = 0
-        self.main_imi.setImage(bg_rem_data) # Remove average background count
-        self.hist.autoHistogramRange()
-        self.calculate_ee()
+        self.background = BackgroundModel(plane=self.bg_model_selector.currentText() == "Plane")
+        self.fit_background()
         self.bg_set_button.setVisible(False)
 
+    def fit_background(self):
+        '''
+        Refit the background model to the pixels under bg_roi (O(ROI)), move the display black
+        level to the background and correct EE
+        '''
+        pos, size = self.bg_roi.pos(), self.bg_roi.size()
+        x0, y0 = int(round(pos.x())), int(round(pos.y()))
+        x1, y1 = int(round(pos.x() + size.x())), int(round(pos.y() + size.y()))
+        if not self.background.fit(self.og_im_data, x0, x1, y0, y1):
+            return
+        # Show the background as black instead of subtracting it from the image
+        level = self.background.value_at(*self.ee_center())
+        high = self.hist.getLevels()[1]
+        self.hist.setLevels(level, max(high, level + 1))
+        self.correct_ee()
+        self.calculate_ee()
 
     def bg_reg_changed(self):
         '''
-        Show 'set background' button and revert to original image
+        Follow the background ROI with the background model, once it is set
         '''
-        if np.array_equal(self.main_imi.image, self.og_im_data) == False:
-            self.main_imi.setImage(self.og_im_data)
-            self.bg_set_button.setVisible(True)
-            self.calculate_ee()
+        if self.background is not None:
+            self.fit_background()
+
+    def bg_model_changed(self, text):
+        '''
+        Switch between a constant and a plane background
+        '''
+        if self.background is not None:
+            self.background.plane = text == "Plane"
+            self.fit_background()
+
+    def background_coefficients(self):
+        '''
+        Background plane (a, b, c) for the EE correction, zero without a background
+        '''
+        if self.background is None:
+            return (0.0, 0.0, 0.0)
+        return self.background.coefficients
+
+    def correct_ee(self):
+        '''
+        Subtracts the background from the EE curve analytically (sum minus the background's sum
+        over the same pixels), costing O(annuli) instead of rewriting the image
+        '''
+        if self.ee.energy is None:
+            return
+        self.ee_energy, self.ee_profile, self.total_counts = self.ee.corrected(
+            self.background_coefficients()
+        )
+        if self.background is not None:
+            self.bg_label.setText(f"{self.background.value_at(*self.ee.center):.4g}")
+        self.plot_ee()
 
 
         
@@ -192,12 +280,30 @@ class MainWindow(QtWidgets.QMainWindow):
         file_name = pg.FileDialog.getOpenFileName(self, "Select Image", "", "FITS Files (*.fits *.fit);;CSV Files (*.csv)")[0]
         self.load_image(file_name)
 
+    def ee_center(self):
+        '''
+        Centre (x, y) of the EE ROI in image pixels
+        '''
+        pos, size = self.ee_roi.pos(), self.ee_roi.size()
+        return (pos.x() + size.x() / 2, pos.y() + size.y() / 2)
+
     def calculate_ee(self):
         '''
-        Subtracts average background from image, calculates percent of energy enclosed in EE_ROI
+        Calculates percent of energy enclosed in EE_ROI. The EE curve is only recomputed
+        when the image or ROI centre changes (over a cutout around the ROI), or the ROI grows
+        past the end of the curve; resizing the ROI is otherwise a lookup.
         '''
-        roi_region = self.ee_roi.getArrayRegion(self.main_imi.image, self.main_imi)
-        ee = np.sum(roi_region)
+        center = self.ee_center()
+        radius = self.ee_roi.size().x() / 2
+        if self.ee_stale:
+            self.ee.set_image(self.main_imi.image)
+        if self.ee_stale or center != self.ee.center or radius > self.ee.max_radius:
+            self.ee.update(center, max(2 * radius, self.ee_min_radius))
+            self.ee_stale = False
+            self.correct_ee()
+        ee = self.ee.energy_at(radius, self.ee_energy)
+        self.ee_radius_line.setValue(radius)
+        self.profile_radius_line.setValue(radius)
         self.dp_roi_size.setText(f"{int(self.ee_roi.size().x())}")
         if self.total_counts != 0:
             self.pc_enc_label.setText(f"{np.round(ee / self.total_counts, 4)} ({int(ee)}/{int(self.total_counts)})")
@@ -205,6 +311,28 @@ class MainWindow(QtWidgets.QMainWindow):
             self.pc_enc_label.setText(f"0 ({ee}/{self.total_counts})")
         
 
+    def plot_ee(self):
+        '''
+        Plots the EE curve (as a fraction of the total) and radial profile
+        '''
+        total = self.total_counts
+        fraction = self.ee_energy / total if total else self.ee_energy
+        self.ee_curve.setData(np.r_[0, self.ee.edges], np.r_[0, fraction])
+        self.profile_curve.setData(self.ee.edges - self.ee.bin_width / 2, self.ee_profile)
+
+    def export_ee(self):
+        '''
+        Saves the EE curve and radial profile to a CSV file
+        '''
+        if self.ee.energy is None:
+            return
+        file_name = pg.FileDialog.getSaveFileName(self, "Save EE Curve", "", "CSV Files (*.csv)")[0]
+        if file_name:
+            # The whole curve, out to the image corners
+            self.ee.update(self.ee.center)
+            self.correct_ee()
+            self.ee.to_csv(file_name, self.background_coefficients())
+
     def dp_roi_size_editing_finished(self):
         '''
         Updates dp_roi_size row of Data Panel
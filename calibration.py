@@ -0,0 +1,311 @@
+"""
+Dark-frame and flat-field calibration.
+
+Master darks and flats are combined from stacks of frames, either captured
+from the GUI or read from a recording, and cached on disk as .npy files with
+an index in calibration.json. A Calibrator picks the masters matching each
+frame's exposure, gain, temperature and geometry and applies them before the
+statistics run.
+
+    python calibration.py dark recordings/Recording_x.frames
+    python calibration.py flat recordings/Recording_y.frames --method sigma_clip
+"""
+import argparse
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+# Ways of combining a stack into a master frame
+COMBINE_MEDIAN = "median"
+COMBINE_SIGMA_CLIP = "sigma_clip"
+
+# Master frame kinds
+MASTER_DARK = "dark"
+MASTER_FLAT = "flat"
+
+# Flat pixels below this fraction of the median are left uncorrected
+MIN_FLAT = 0.05
+
+
+def combine_frames(
+    frames, method=COMBINE_MEDIAN, sigma=3.0, iterations=3, chunk_rows=64, shift=0
+):
+    """
+    Combine a stack of frames pixel by pixel into a float32 master frame.
+
+    `frames` is any sequence of 2D frames: a list, an (n, height, width)
+    array or a recording's memmap. Rows are combined `chunk_rows` at a time,
+    so memory stays at n x chunk_rows x width values however large the stack.
+    Frames are right shifted by `shift` bits first (recordings are raw).
+    """
+    count = len(frames)
+    if count == 0:
+        raise ValueError("No frames to combine")
+    if method not in (COMBINE_MEDIAN, COMBINE_SIGMA_CLIP):
+        raise ValueError(f"Unknown combination method: {method}")
+    height, width = frames[0].shape
+    master = np.empty((height, width), dtype=np.float32)
+    block = np.empty((count, min(chunk_rows, height), width), dtype=np.float32)
+    for start in range(0, height, chunk_rows):
+        stop = min(start + chunk_rows, height)
+        chunk = block[:, : stop - start]
+        for i, frame in enumerate(frames):
+            rows = frame[start:stop]
+            chunk[i] = rows >> shift if shift else rows
+        if method == COMBINE_MEDIAN:
+            np.median(chunk, axis=0, out=master[start:stop])
+        else:
+            master[start:stop] = sigma_clipped_mean(chunk, sigma, iterations)
+    return master
+
+
+def sigma_clipped_mean(chunk, sigma=3.0, iterations=3):
+    """
+    Per-pixel mean along axis 0 after rejecting values more than `sigma`
+    standard deviations from the centre, starting from the median and
+    iterating until nothing more is rejected.
+    """
+    center = np.median(chunk, axis=0)
+    keep = np.ones(chunk.shape, dtype=bool)
+    deviation = np.empty_like(chunk)
+    for _ in range(iterations):
+        count = np.maximum(keep.sum(axis=0), 1)
+        np.subtract(chunk, center, out=deviation)
+        deviation *= deviation
+        std = np.sqrt(np.where(keep, deviation, 0).sum(axis=0) / count)
+        clipped = deviation <= (sigma * std) ** 2
+        if np.array_equal(clipped, keep):
+            break
+        keep = clipped
+        center = np.where(keep, chunk, 0).sum(axis=0) / np.maximum(keep.sum(axis=0), 1)
+    kept = keep.sum(axis=0)
+    mean = np.where(keep, chunk, 0).sum(axis=0) / np.maximum(kept, 1)
+    # Pixels with everything rejected fall back to the median
+    return np.where(kept > 0, mean, np.median(chunk, axis=0))
+
+
+class CalibrationLibrary:
+    """
+    Master darks and flats cached on disk.
+
+    Each master is an .npy file in `directory`, listed in calibration.json
+    with the exposure, gain, temperature and sensor geometry it was taken at.
+    Darks are matched on exposure and gain and the nearest temperature within
+    `temperature_tolerance`; flats on binning. A master taken over a larger
+    part of the sensor is cropped to the frame, so full-frame masters also
+    serve hardware ROI frames.
+    """
+
+    def __init__(self, directory="calibration", temperature_tolerance=2.0):
+        # The directory is only created when the first master is saved
+        self.directory = directory
+        self.temperature_tolerance = temperature_tolerance
+        self.index_path = os.path.join(directory, "calibration.json")
+        self.entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as file:
+                self.entries = json.load(file)
+        self._cache = {}  # File name: loaded master
+
+    def add(self, kind, master, exposure, gain, temperature, geometry, frames, method):
+        # Save a master and list it in the index
+        name = time.strftime(f"{kind}_%Y%m%d_%H%M%S") + f"_{len(self.entries)}.npy"
+        os.makedirs(self.directory, exist_ok=True)
+        np.save(os.path.join(self.directory, name), master)
+        entry = {
+            "kind": kind,
+            "file": name,
+            "exposure": float(exposure),
+            "gain": float(gain),
+            "temperature": None if math.isnan(temperature) else float(temperature),
+            "geometry": list(geometry),
+            "shape": list(master.shape),
+            "frames": frames,
+            "method": method,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self.entries.append(entry)
+        with open(self.index_path, "w") as file:
+            json.dump(self.entries, file, indent=2)
+        self._cache[name] = master
+        return entry
+
+    def build_dark(
+        self, frames, exposure, gain, temperature=float("nan"), geometry=(0, 0, 1),
+        method=COMBINE_MEDIAN, shift=0,
+    ):
+        """
+        Combine a stack of dark frames into a master dark and cache it.
+        """
+        master = combine_frames(frames, method=method, shift=shift)
+        return self.add(
+            MASTER_DARK, master, exposure, gain, temperature, geometry, len(frames), method
+        )
+
+    def build_flat(
+        self, frames, exposure, gain, temperature=float("nan"), geometry=(0, 0, 1),
+        method=COMBINE_MEDIAN, shift=0,
+    ):
+        """
+        Combine a stack of flat frames into a master flat, normalised to a
+        median of 1, and cache it. A matching master dark is subtracted first
+        if there is one.
+        """
+        master = combine_frames(frames, method=method, shift=shift)
+        dark = self.find_dark(exposure, gain, temperature, geometry, master.shape)
+        if dark is None:
+            print("No master dark for the flats, using them uncorrected")
+        else:
+            master -= dark
+        median = np.median(master)
+        if median <= 0:
+            raise ValueError("Flat frames have no signal above the dark level")
+        master /= median
+        return self.add(
+            MASTER_FLAT, master, exposure, gain, temperature, geometry, len(frames), method
+        )
+
+    def load(self, entry):
+        master = self._cache.get(entry["file"])
+        if master is None:
+            master = np.load(os.path.join(self.directory, entry["file"]))
+            self._cache[entry["file"]] = master
+        return master
+
+    def crop(self, entry, geometry, shape):
+        """
+        View of a master over a frame with `geometry` and `shape`, or None if
+        the master doesn't cover the frame at the same binning.
+        """
+        x0, y0, bins = geometry
+        master_x0, master_y0, master_bins = entry["geometry"]
+        if bins != master_bins:
+            return None
+        dx, rx = divmod(x0 - master_x0, bins)
+        dy, ry = divmod(y0 - master_y0, bins)
+        height, width = entry["shape"]
+        if rx or ry or dx < 0 or dy < 0 or dy + shape[0] > height or dx + shape[1] > width:
+            return None
+        return self.load(entry)[dy : dy + shape[0], dx : dx + shape[1]]
+
+    def find_dark(self, exposure, gain, temperature, geometry, shape):
+        # Cropped master dark for these settings, the newest at the nearest
+        # temperature, or None
+        best = None
+        for entry in self.entries:
+            if entry["kind"] != MASTER_DARK or entry["gain"] != gain:
+                continue
+            if not math.isclose(entry["exposure"], exposure, rel_tol=1e-6):
+                continue
+            difference = 0.0
+            if entry["temperature"] is not None and not math.isnan(temperature):
+                difference = abs(entry["temperature"] - temperature)
+                if difference > self.temperature_tolerance:
+                    continue
+            master = self.crop(entry, geometry, shape)
+            if master is not None and (best is None or difference <= best[0]):
+                best = (difference, master)
+        return None if best is None else best[1]
+
+    def find_flat(self, geometry, shape):
+        # Newest cropped master flat covering the frame, or None
+        for entry in reversed(self.entries):
+            if entry["kind"] == MASTER_FLAT:
+                master = self.crop(entry, geometry, shape)
+                if master is not None:
+                    return master
+        return None
+
+
+class Calibrator:
+    """
+    Applies the matching master dark and flat to each frame.
+
+    The masters are looked up only when a frame's settings change. The result
+    is written into one preallocated float32 buffer, reused every frame, so
+    calibration costs two vectorised passes and no allocation; dark-subtracted
+    values can go below zero and are kept that way so background levels stay
+    unbiased.
+    """
+
+    def __init__(self, library):
+        self.library = library
+        self.dark = None
+        self.inverse_flat = None
+        self._key = None
+        self._out = None
+
+    def refresh(self):
+        # Look the masters up again on the next frame (e.g. after adding one)
+        self._key = None
+
+    def _select(self, frame, record):
+        shape = frame.shape
+        self.dark = self.library.find_dark(
+            record.exposure, record.gain, record.temperature, record.geometry, shape
+        )
+        flat = self.library.find_flat(record.geometry, shape)
+        self.inverse_flat = None
+        if flat is not None:
+            # Multiplying by the inverse is cheaper than dividing every frame
+            self.inverse_flat = np.ones(shape, dtype=np.float32)
+            np.divide(1, flat, out=self.inverse_flat, where=flat >= MIN_FLAT)
+
+    def apply(self, frame, record):
+        """
+        Calibrated copy of `frame` (a buffer reused by the next call), or the
+        frame itself if there are no masters for it.
+        """
+        temperature = record.temperature
+        if not math.isnan(temperature):
+            # Temperature drifts slowly; only look again every half degree
+            temperature = round(temperature * 2) / 2
+        key = (record.exposure, record.gain, temperature, record.geometry, frame.shape)
+        if key != self._key:
+            self._key = key
+            self._select(frame, record)
+        if self.dark is None and self.inverse_flat is None:
+            return frame
+
+        if self._out is None or self._out.shape != frame.shape:
+            self._out = np.empty(frame.shape, dtype=np.float32)
+        if self.dark is not None:
+            np.subtract(frame, self.dark, out=self._out)
+        else:
+            np.copyto(self._out, frame)
+        if self.inverse_flat is not None:
+            self._out *= self.inverse_flat
+        return self._out
+
+
+if __name__ == "__main__":
+    from frameRecorder import FrameStack
+
+    parser = argparse.ArgumentParser(description="Build a master frame from a recording")
+    parser.add_argument("kind", choices=[MASTER_DARK, MASTER_FLAT])
+    parser.add_argument("recording", help="Frame stack (.frames) of darks or flats")
+    parser.add_argument("--method", choices=[COMBINE_MEDIAN, COMBINE_SIGMA_CLIP],
+                        default=COMBINE_MEDIAN)
+    parser.add_argument("--geometry", type=int, nargs=3, default=(0, 0, 1),
+                        metavar=("X0", "Y0", "BINS"),
+                        help="Sensor origin and binning the recording was taken with")
+    parser.add_argument("--directory", default="calibration")
+    args = parser.parse_args()
+
+    stack = FrameStack(args.recording)
+    # Settings of the recording, from its per-frame metadata
+    exposure = float(np.median(stack.metadata["exposure"]))
+    gain = float(np.median(stack.metadata["gain"]))
+    temperature = float(np.nanmedian(stack.metadata["temperature"])) \
+        if np.isfinite(stack.metadata["temperature"]).any() else float("nan")
+
+    library = CalibrationLibrary(args.directory)
+    build = library.build_dark if args.kind == MASTER_DARK else library.build_flat
+    entry = build(
+        stack.frames, exposure, gain, temperature, tuple(args.geometry),
+        method=args.method, shift=16 - stack.bit_depth,
+    )
+    print(f"Saved master {args.kind} of {entry['frames']} frames to {entry['file']}")
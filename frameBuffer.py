@@ -0,0 +1,194 @@
+import threading
+from collections import deque
+
+import numpy as np
+
+# Ring buffer modes
+LATEST_ONLY = "latest"  # Consumer only ever sees the newest frame
+DROP_OLDEST = "drop_oldest"  # FIFO, oldest unread frame is overwritten when full
+
+
+class FrameRecord:
+    """
+    A frame and the camera state it was captured with.
+
+    The ring buffer owns one record per slot. The producer fills in the
+    metadata of a claimed slot before committing it, so the consumer always
+    sees the exposure, gain and sensor geometry the frame was actually taken
+    with, not whatever the GUI has most recently asked for.
+    """
+
+    __slots__ = (
+        "data",  # Frame in sensor (row, column) order
+        "seq",  # Capture sequence number
+        "timestamp",  # time.time() when the capture finished
+        "exposure",  # s
+        "gain",
+        "temperature",  # C
+        "geometry",  # (x0, y0, bins): sensor origin (unbinned pixels) and binning
+    )
+
+    def __init__(
+        self,
+        data=None,
+        seq=-1,
+        timestamp=float("nan"),
+        exposure=float("nan"),
+        gain=0,
+        temperature=float("nan"),
+        geometry=(0, 0, 1),
+    ):
+        self.data = data
+        self.seq = seq
+        self.timestamp = timestamp
+        self.exposure = exposure
+        self.gain = gain
+        self.temperature = temperature
+        self.geometry = geometry
+
+    def metadata(self):
+        # Copy without the frame data, safe to keep after the slot is reused
+        return FrameRecord(
+            None,
+            self.seq,
+            self.timestamp,
+            self.exposure,
+            self.gain,
+            self.temperature,
+            self.geometry,
+        )
+
+
+class FrameRingBuffer:
+    """
+    Fixed-depth ring of preallocated uint16 frames shared between the capture
+    thread (producer) and the GUI (consumer).
+
+    Each slot is a FrameRecord. The producer claims a free slot, fills in the
+    frame and its metadata and commits it. The consumer pops a slot and holds
+    it until the next pop, so the producer never writes into a frame that is
+    still being displayed or analysed.
+
+    Each slot is backed by a bytearray so zwoasi can capture straight into it
+    (``capture_video_frame(buffer_=ring.buffers[index])``) without allocating.
+    """
+
+    def __init__(self, shape=None, depth=4, mode=LATEST_ONLY, dtype=np.uint16):
+        if depth < 2:
+            raise ValueError("Ring buffer depth must be at least 2")
+        if mode not in (LATEST_ONLY, DROP_OLDEST):
+            raise ValueError(f"Unknown ring buffer mode: {mode}")
+
+        self.depth = depth
+        self.mode = mode
+        self.dtype = np.dtype(dtype)
+        self.shape = None
+        self.buffers = []  # Raw slot memory handed to the camera SDK
+        self.records = []  # FrameRecords with NumPy views onto the slot buffers
+
+        self._lock = threading.Lock()
+        self._queue = deque()  # Committed slots, oldest first
+        self._free = deque()
+        self._reading = None  # Slot currently leased to the consumer
+        self._signalled = False  # Consumer has been notified of pending frames
+
+        # Counters
+        self.dropped = 0
+        self.delivered = 0
+
+        if shape is not None:
+            self.resize(shape)
+
+    def resize(self, shape):
+        """
+        (Re)allocate the slots for a new frame shape. Pending frames are discarded.
+        """
+        shape = tuple(shape)
+        with self._lock:
+            if shape == self.shape:
+                return
+            self.shape = shape
+            nbytes = int(np.prod(shape)) * self.dtype.itemsize
+            self.buffers = [bytearray(nbytes) for _ in range(self.depth)]
+            self.records = [
+                FrameRecord(np.frombuffer(buffer_, dtype=self.dtype).reshape(shape))
+                for buffer_ in self.buffers
+            ]
+            self._queue.clear()
+            self._free = deque(range(self.depth))
+            self._reading = None
+
+    def set_mode(self, mode):
+        if mode not in (LATEST_ONLY, DROP_OLDEST):
+            raise ValueError(f"Unknown ring buffer mode: {mode}")
+        with self._lock:
+            self.mode = mode
+            self._trim()
+
+    def claim(self):
+        """
+        Return (index, record) of a slot the producer may fill.
+        If every slot is full the oldest unread frame is dropped.
+        """
+        with self._lock:
+            if self._free:
+                index = self._free.popleft()
+            else:
+                index = self._queue.popleft()
+                self.dropped += 1
+            return index, self.records[index]
+
+    def commit(self, index):
+        """
+        Publish a filled slot. Returns True if the consumer needs to be notified.
+        """
+        with self._lock:
+            self._queue.append(index)
+            self._trim()
+            notify = not self._signalled
+            self._signalled = True
+            return notify
+
+    def abort(self, index):
+        # Return a claimed slot without publishing it (e.g. capture failed)
+        with self._lock:
+            self._free.append(index)
+
+    def acknowledge(self):
+        # Called by the consumer before draining, so later commits notify again
+        with self._lock:
+            self._signalled = False
+
+    def pop(self):
+        """
+        Lease the next record to the consumer, releasing the previous lease.
+        Returns None (and keeps the current lease) if no frame is pending.
+        """
+        with self._lock:
+            if not self._queue:
+                return None
+            self._release()
+            index = self._queue.popleft()
+            self._reading = index
+            self.delivered += 1
+            return self.records[index]
+
+    def release(self):
+        with self._lock:
+            self._release()
+
+    def pending(self):
+        with self._lock:
+            return len(self._queue)
+
+    def _release(self):
+        if self._reading is not None:
+            self._free.append(self._reading)
+            self._reading = None
+
+    def _trim(self):
+        # In latest-only mode everything but the newest committed frame is stale
+        if self.mode == LATEST_ONLY:
+            while len(self._queue) > 1:
+                self._free.append(self._queue.popleft())
+                self.dropped += 1
@@ -0,0 +1,192 @@
+import os
+import queue
+import struct
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# Frame stack file layout:
+#   fixed header (HEADER_SIZE bytes): magic, version, dtype, bit depth,
+#       frame height and width, frame count and the offset of the index
+#   frame block: frame_count contiguous frames of height x width
+#   index: one METADATA_DTYPE record per frame
+FRAME_STACK_EXTENSION = ".frames"
+FRAME_STACK_MAGIC = b"ZWOSTACK"
+FRAME_STACK_VERSION = 1
+HEADER = struct.Struct("<8sH8sHIIQQ")
+HEADER_SIZE = 512  # Keeps the frame block aligned for np.memmap
+METADATA_DTYPE = np.dtype(
+    [
+        ("timestamp", "<f8"),
+        ("exposure", "<f8"),
+        ("gain", "<f8"),
+        ("temperature", "<f8"),
+    ]
+)
+
+
+def pack_header(dtype, bit_depth, shape, frame_count, index_offset):
+    header = HEADER.pack(
+        FRAME_STACK_MAGIC,
+        FRAME_STACK_VERSION,
+        np.dtype(dtype).str.encode(),
+        bit_depth,
+        shape[0],
+        shape[1],
+        frame_count,
+        index_offset,
+    )
+    return header.ljust(HEADER_SIZE, b"\0")
+
+
+class FrameStack:
+    """
+    Read-only view of a recorded frame stack.
+
+    ``frames`` is an np.memmap of shape (frame_count, height, width), so any
+    frame can be accessed without loading the recording into memory.
+    ``metadata`` is a structured array with one METADATA_DTYPE record per frame.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            fields = HEADER.unpack(file.read(HEADER.size))
+        magic, version, dtype, bit_depth, height, width, count, index_offset = fields
+        if magic != FRAME_STACK_MAGIC:
+            raise ValueError(f"{path} is not a frame stack file")
+        if version > FRAME_STACK_VERSION:
+            raise ValueError(f"Unsupported frame stack version {version}")
+
+        self.dtype = np.dtype(dtype.rstrip(b"\0").decode())
+        self.bit_depth = bit_depth
+        self.shape = (height, width)
+        frame_bytes = height * width * self.dtype.itemsize
+
+        if index_offset == 0:
+            # Recording was interrupted before the index was written
+            count = (os.path.getsize(path) - HEADER_SIZE) // frame_bytes
+            self.metadata = np.zeros(count, dtype=METADATA_DTYPE)
+            self.metadata[:] = np.nan
+        else:
+            self.metadata = np.fromfile(
+                path, dtype=METADATA_DTYPE, count=count, offset=index_offset
+            )
+
+        if count > 0:
+            self.frames = np.memmap(
+                path,
+                dtype=self.dtype,
+                mode="r",
+                offset=HEADER_SIZE,
+                shape=(count, height, width),
+            )
+        else:
+            self.frames = np.empty((0, height, width), dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    def roi_series(self, mask, start=0, stop=None, transpose=True):
+        """
+        ROI statistics for each frame in [start, stop). ROI masks from the GUI
+        are in display coordinates, i.e. on the transposed frame.
+        """
+        return [
+            mask.stats(frame.T if transpose else frame)
+            for frame in self.frames[start:stop]
+        ]
+
+
+class FrameRecorder:
+    """
+    Streams raw frames and per-frame metadata to a frame stack file from a
+    writer thread.
+
+    Frames are copied into a bounded pool of preallocated buffers and queued
+    for the writer, so the capture loop never waits on disk I/O. If the pool
+    is exhausted the frame is dropped and counted instead.
+    """
+
+    def __init__(self, path, shape, dtype=np.uint16, bit_depth=16, queue_depth=64):
+        if not path.endswith(FRAME_STACK_EXTENSION):
+            path += FRAME_STACK_EXTENSION
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.bit_depth = bit_depth
+
+        self._buffers = [np.empty(self.shape, dtype=self.dtype) for _ in range(queue_depth)]
+        self._free = deque(range(queue_depth))
+        self._queue = queue.Queue()
+
+        # Per-frame metadata, written as the index when the recording closes
+        self._metadata = []
+
+        # Header is rewritten with the frame count and index offset on close
+        self._file = open(path, "wb")
+        self._file.write(pack_header(self.dtype, bit_depth, self.shape, 0, 0))
+
+        # Counters
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.dropped = 0
+        self.start_time = time.perf_counter()
+
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def write(self, frame, timestamp, exposure, gain, temperature):
+        """
+        Queue a frame for writing. Never blocks; returns False if it was dropped.
+        """
+        if frame.shape != self.shape:
+            # e.g. the camera ROI changed mid-recording
+            self.dropped += 1
+            return False
+        try:
+            index = self._free.popleft()
+        except IndexError:
+            self.dropped += 1
+            return False
+        np.copyto(self._buffers[index], frame)
+        self._queue.put((index, (timestamp, exposure, gain, temperature)))
+        return True
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            index, metadata = item
+            frame = self._buffers[index]
+            self._file.write(frame.data)
+            self._metadata.append(metadata)
+            self._free.append(index)
+            self.frames_written += 1
+            self.bytes_written += frame.nbytes
+
+    def throughput(self):
+        # Sustained write rate in MB/s since the recording started
+        elapsed = time.perf_counter() - self.start_time
+        return self.bytes_written / 1e6 / elapsed if elapsed > 0 else 0.0
+
+    def close(self):
+        # Write out whatever is still queued, then the index and final header
+        self._queue.put(None)
+        self._thread.join()
+        index = np.array(self._metadata, dtype=METADATA_DTYPE)
+        index_offset = self._file.tell()
+        self._file.write(index.tobytes())
+        self._file.seek(0)
+        self._file.write(
+            pack_header(
+                self.dtype, self.bit_depth, self.shape, len(index), index_offset
+            )
+        )
+        self._file.close()
@@ -0,0 +1,133 @@
+import numpy as np
+
+# Stacking modes
+STACK_CUMULATIVE = "cumulative"  # Every frame since the last reset
+STACK_WINDOW = "window"  # The last `length` frames
+STACK_EMA = "ema"  # Exponential moving average with a span of `length` frames
+
+
+class FrameStacker:
+    """
+    Co-adds frames in real time, keeping the per-pixel mean and variance.
+
+    Cumulative stacking uses Welford's update in float64. The sliding window
+    keeps the last `length` frames plus running sums of the values and their
+    squares (exact in int64 for integer frames, float64 otherwise), so adding
+    a frame and dropping the oldest is the same cost however long the window.
+    The exponential average weights frames by 2 / (length + 1). Every mode is
+    a fixed number of vectorised passes over the frame, done in place in
+    preallocated buffers.
+    """
+
+    def __init__(self, mode=STACK_CUMULATIVE, length=16):
+        if mode not in (STACK_CUMULATIVE, STACK_WINDOW, STACK_EMA):
+            raise ValueError(f"Unknown stacking mode: {mode}")
+        self.mode = mode
+        self.length = max(int(length), 1)
+        self.shape = None
+        self.dtype = None
+        self.count = 0
+        self.reset()
+
+    def reset(self):
+        # Accumulators are (re)allocated by the next frame
+        self.shape = None
+        self.count = 0
+
+    def _allocate(self, frame):
+        # Buffers follow the frame's memory order (the GUI frame is a
+        # transposed view), so every pass is over contiguous memory
+        self.shape = frame.shape
+        self.dtype = frame.dtype
+        self.count = 0
+        self.mean = np.zeros_like(frame, dtype=np.float64)
+        self._variance = np.zeros_like(frame, dtype=np.float64)
+        self._delta = np.empty_like(frame, dtype=np.float64)
+        if self.mode == STACK_CUMULATIVE or self.mode == STACK_EMA:
+            self._m2 = np.zeros_like(frame, dtype=np.float64)
+        if self.mode == STACK_WINDOW:
+            # Calibrated frames are float
+            dtype = np.int64 if np.issubdtype(frame.dtype, np.integer) else np.float64
+            self._frames = [np.empty_like(frame) for _ in range(self.length)]
+            self._sum = np.zeros_like(frame, dtype=dtype)
+            self._sum_squares = np.zeros_like(frame, dtype=dtype)
+            self._square = np.empty_like(frame, dtype=dtype)
+            self._next = 0
+
+    def update(self, frame):
+        """
+        Add a frame to the stack. Returns the stacked mean (a buffer that is
+        updated in place by later frames).
+        """
+        if frame.shape != self.shape or frame.dtype != self.dtype:
+            self._allocate(frame)
+        if self.mode == STACK_CUMULATIVE:
+            self._update_cumulative(frame)
+        elif self.mode == STACK_WINDOW:
+            self._update_window(frame)
+        else:
+            self._update_ema(frame)
+        return self.mean
+
+    def _update_cumulative(self, frame):
+        # Welford: mean += (x - mean) / n, M2 += (x - mean_old) * (x - mean_new)
+        self.count += 1
+        delta = self._delta
+        np.subtract(frame, self.mean, out=delta)
+        self.mean += delta / self.count
+        np.subtract(frame, self.mean, out=self._variance)
+        self._variance *= delta
+        self._m2 += self._variance
+
+    def _update_window(self, frame):
+        slot = self._frames[self._next]
+        if self.count == self.length:
+            # Drop the oldest frame, which is in the slot about to be reused
+            self._sum -= slot
+            np.multiply(slot, slot, dtype=self._square.dtype, out=self._square)
+            self._sum_squares -= self._square
+        else:
+            self.count += 1
+        np.copyto(slot, frame)
+        self._sum += slot
+        np.multiply(slot, slot, dtype=self._square.dtype, out=self._square)
+        self._sum_squares += self._square
+        self._next = (self._next + 1) % self.length
+        np.divide(self._sum, self.count, out=self.mean)
+
+    def _update_ema(self, frame):
+        # Exponentially weighted mean and variance
+        alpha = 2 / (self.length + 1)
+        if self.count == 0:
+            self.mean[...] = frame
+        self.count += 1
+        delta = self._delta
+        np.subtract(frame, self.mean, out=delta)
+        self.mean += alpha * delta
+        # var = (1 - alpha) * (var + alpha * delta^2)
+        delta *= delta
+        delta *= alpha
+        self._m2 += delta
+        self._m2 *= 1 - alpha
+
+    def sum(self):
+        # Per-pixel sum of the stacked frames
+        if self.mode == STACK_WINDOW:
+            return self._sum
+        return self.mean * self.count
+
+    def variance(self):
+        """
+        Per-pixel variance of the stacked frames.
+        """
+        if self.count == 0:
+            return self._variance
+        if self.mode == STACK_CUMULATIVE:
+            np.divide(self._m2, self.count, out=self._variance)
+        elif self.mode == STACK_WINDOW:
+            np.divide(self._sum_squares, self.count, out=self._variance)
+            self._variance -= self.mean**2
+            np.maximum(self._variance, 0, out=self._variance)
+        else:
+            self._variance[...] = self._m2
+        return self._variance
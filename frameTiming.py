@@ -0,0 +1,91 @@
+import time
+
+import numpy as np
+
+# Pipeline stages, in the order a frame passes through them
+STAGES = ("capture_start", "captured", "dequeued", "processed", "stats", "displayed")
+
+
+class FrameTimer:
+    """
+    Per-frame, per-stage timestamps in a fixed-size table.
+
+    Row ``seq % capacity`` holds the time.perf_counter_ns() stamps of frame
+    ``seq``, one column per stage. Each stage is stamped by exactly one thread
+    with a plain array store, so recording needs no locks. Old rows are simply
+    overwritten.
+    """
+
+    def __init__(self, capacity=4096, stages=STAGES):
+        self.capacity = capacity
+        self.stages = stages
+        self.stamps = np.zeros((capacity, len(stages)), dtype=np.int64)
+        self.seqs = np.full(capacity, -1, dtype=np.int64)
+        self._columns = {stage: i for i, stage in enumerate(stages)}
+
+    def start(self, seq):
+        # Claim the row for a new frame and stamp its first stage
+        row = seq % self.capacity
+        self.stamps[row] = 0
+        self.seqs[row] = seq
+        self.stamps[row, 0] = time.perf_counter_ns()
+
+    def mark(self, seq, stage):
+        row = seq % self.capacity
+        if self.seqs[row] == seq:
+            self.stamps[row, self._columns[stage]] = time.perf_counter_ns()
+
+    def _rows(self):
+        # Rows in use, oldest frame first
+        order = np.argsort(self.seqs)
+        return order[self.seqs[order] >= 0]
+
+    def stage_latencies(self):
+        """
+        Dict of stage -> array of latencies (ms) from the previous stage, plus
+        "total" from capture start to display, over frames that reached both.
+        """
+        stamps = self.stamps[self._rows()]
+        latencies = {}
+        for i in range(1, len(self.stages)):
+            valid = (stamps[:, i] > 0) & (stamps[:, i - 1] > 0)
+            latencies[self.stages[i]] = (stamps[valid, i] - stamps[valid, i - 1]) / 1e6
+        valid = (stamps[:, -1] > 0) & (stamps[:, 0] > 0)
+        latencies["total"] = (stamps[valid, -1] - stamps[valid, 0]) / 1e6
+        return latencies
+
+    def rate(self, stage, window=1.0):
+        # Frames per second reaching a stage over the last `window` seconds
+        column = self.stamps[:, self._columns[stage]]
+        now = time.perf_counter_ns()
+        return np.count_nonzero(column > now - window * 1e9) / window
+
+    def summary(self):
+        """
+        Text summary: capture and display fps and p50/p99 latency per stage.
+        """
+        lines = [
+            f"Capture: {self.rate('captured'):.1f} fps   "
+            f"Display: {self.rate('displayed'):.1f} fps"
+        ]
+        for stage, values in self.stage_latencies().items():
+            if len(values):
+                p50, p99 = np.percentile(values, [50, 99])
+                lines.append(f"{stage:>10}: p50 {p50:7.2f} ms  p99 {p99:7.2f} ms")
+        return "\n".join(lines)
+
+    def export_csv(self, path):
+        # One row per frame: sequence number and the stamp of each stage (ms)
+        rows = self._rows()
+        stamps = self.stamps[rows].astype(np.float64)
+        stamps[stamps == 0] = np.nan
+        origin = np.nanmin(stamps) if np.isfinite(stamps).any() else 0
+        table = np.column_stack([self.seqs[rows], (stamps - origin) / 1e6])
+        np.savetxt(
+            path,
+            table,
+            delimiter=",",
+            fmt=["%d"] + ["%.3f"] * len(self.stages),
+            header="seq," + ",".join(f"{stage}_ms" for stage in self.stages),
+            comments="",
+        )
@@ -0,0 +1,582 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Statistics of the pixels inside one ROI for a single frame
+ROIStats = namedtuple("ROIStats", ["sum", "mean", "std", "min", "max", "count"])
+EMPTY_STATS = ROIStats(0.0, 0.0, 0.0, 0.0, 0.0, 0)
+
+# Position (pixel-centre frame index coordinates), widths and background
+# subtracted signal of a tracked spot
+SpotFit = namedtuple("SpotFit", ["x", "y", "fwhm_x", "fwhm_y", "signal"])
+FWHM_PER_SIGMA = 2 * np.sqrt(2 * np.log(2))
+
+# Spot tracking methods
+TRACK_CENTROID = "centroid"  # Intensity-weighted centroid and second moments
+TRACK_GAUSSIAN = "gaussian"  # Gaussian fits to the x and y profiles
+
+
+class ROIMask:
+    """
+    Cached pixel mask for a rectangular or elliptical ROI.
+
+    Geometry is given in frame index coordinates (axis 0, axis 1), which is
+    what a col-major pyqtgraph ImageItem uses for its x and y. A pixel belongs
+    to the ROI when its centre does. The mask is only rebuilt when the geometry
+    or frame shape changes, so per-frame statistics are a single gather over the
+    cached pixels with no resampling.
+    """
+
+    def __init__(self, elliptical=False):
+        self.elliptical = elliptical
+        self.pos = (0.0, 0.0)
+        self.size = (0.0, 0.0)
+
+        self.shape = None
+        self.slices = (slice(0, 0), slice(0, 0))  # Bounding box within the frame
+        self.mask = None  # Boolean mask over the bounding box (ellipses only)
+        self.count = 0
+        self._dirty = True
+
+    def set_geometry(self, pos, size):
+        pos = (float(pos[0]), float(pos[1]))
+        size = (float(size[0]), float(size[1]))
+        if pos != self.pos or size != self.size:
+            self.pos = pos
+            self.size = size
+            self._dirty = True
+
+    def bounds(self, shape):
+        """
+        Integer bounding box (x0, x1, y0, y1) of the ROI, clipped to the frame.
+        """
+        x0 = min(max(int(np.floor(self.pos[0] + 0.5)), 0), shape[0])
+        x1 = min(max(int(np.floor(self.pos[0] + self.size[0] + 0.5)), x0), shape[0])
+        y0 = min(max(int(np.floor(self.pos[1] + 0.5)), 0), shape[1])
+        y1 = min(max(int(np.floor(self.pos[1] + self.size[1] + 0.5)), y0), shape[1])
+        return x0, x1, y0, y1
+
+    def update(self, shape):
+        # Rebuild the mask if the ROI moved or the frame shape changed
+        shape = tuple(shape[:2])
+        if not self._dirty and shape == self.shape:
+            return
+        self.shape = shape
+        self._dirty = False
+
+        x0, x1, y0, y1 = self.bounds(shape)
+        self.slices = (slice(x0, x1), slice(y0, y1))
+
+        if not self.elliptical:
+            self.mask = None
+            self.count = (x1 - x0) * (y1 - y0)
+            return
+
+        # Pixel centres relative to the ellipse centre, in units of the radii
+        rx = self.size[0] / 2
+        ry = self.size[1] / 2
+        if rx <= 0 or ry <= 0:
+            self.mask = np.zeros((x1 - x0, y1 - y0), dtype=bool)
+            self.count = 0
+            return
+        dx = (np.arange(x0, x1) + 0.5 - (self.pos[0] + rx)) / rx
+        dy = (np.arange(y0, y1) + 0.5 - (self.pos[1] + ry)) / ry
+        self.mask = dx[:, None] ** 2 + dy[None, :] ** 2 <= 1
+        self.count = int(np.count_nonzero(self.mask))
+
+    def pixels(self, frame):
+        """
+        Values of the ROI pixels in a frame (a view for rectangles).
+        """
+        self.update(frame.shape)
+        cutout = frame[self.slices]
+        if self.mask is not None:
+            return cutout[self.mask]
+        return cutout
+
+    def stats(self, frame):
+        """
+        Sum, mean, std, min, max and pixel count of the ROI in a frame.
+        """
+        values = self.pixels(frame)
+        if self.count == 0:
+            return EMPTY_STATS
+        return array_stats(values)
+
+
+def array_stats(values):
+    # Statistics of an array of pixel values in float64 (no uint16 overflow)
+    values = np.asarray(values, dtype=np.float64).ravel()
+    count = values.size
+    total = values.sum()
+    mean = total / count
+    variance = max(np.dot(values, values) / count - mean * mean, 0.0)
+    return ROIStats(
+        total, mean, np.sqrt(variance), values.min(), values.max(), count
+    )
+
+
+class IntegralImage:
+    """
+    Summed-area tables of a frame and of its square.
+
+    Building the tables is one pass over the frame; after that the sum, mean
+    and std of any axis-aligned box are four lookups each, so the cost stays
+    flat no matter how many rectangular ROIs are evaluated. That flat cost is
+    high, though: on 1280x960 frames the tables take about 16 ns per frame
+    pixel (20 ms), while ROIMask.stats takes about 15 us plus 5 ns per pixel
+    of its box. The tables only pay off once the boxes add up to about three
+    times the frame (many overlapping ROIs), or there are over a thousand
+    small ones; pays_off makes that call.
+    """
+
+    # Fixed cost of an ROI's mask statistics, in pixels of box
+    MASK_OVERHEAD_PIXELS = 3000
+    # Cost of the tables per frame pixel relative to a mask per box pixel
+    TABLE_COST_RATIO = 3.0
+
+    @classmethod
+    def pays_off(cls, boxes, shape):
+        """
+        Whether building the tables is cheaper than masks for boxes given as
+        rows of (x0, x1, y0, y1) on a frame of `shape`.
+        """
+        boxes = np.asarray(boxes, dtype=np.intp).reshape(-1, 4)
+        areas = (boxes[:, 1] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 2])
+        mask_cost = areas.sum() + cls.MASK_OVERHEAD_PIXELS * len(boxes)
+        return mask_cost > cls.TABLE_COST_RATIO * shape[0] * shape[1]
+
+    def __init__(self):
+        self.shape = None
+        self.dtype = None
+        self.transposed = False
+        # Tables are padded with a leading row and column of zeros
+        self.sum_table = None
+        self.square_table = None
+        self._square = None
+
+    def update(self, frame):
+        # Integer frames accumulate exactly in int64, anything else in float64
+        if np.issubdtype(frame.dtype, np.integer):
+            dtype = np.dtype(np.int64)
+        else:
+            dtype = np.dtype(np.float64)
+        # Work in the frame's memory order (the GUI frame is a transposed view)
+        transposed = frame.flags.f_contiguous and not frame.flags.c_contiguous
+        values = frame.T if transposed else frame
+
+        shape = frame.shape[:2]
+        if (shape, dtype, transposed) != (self.shape, self.dtype, self.transposed):
+            self.shape = shape
+            self.dtype = dtype
+            self.transposed = transposed
+            padded = (values.shape[0] + 1, values.shape[1] + 1)
+            self._sums = np.zeros(padded, dtype=dtype)
+            self._squares = np.zeros(padded, dtype=dtype)
+            self._square = np.empty(values.shape, dtype=dtype)
+            self.sum_table = self._sums.T if transposed else self._sums
+            self.square_table = self._squares.T if transposed else self._squares
+
+        self._integrate(values, self._sums[1:, 1:])
+        np.multiply(values, values, dtype=dtype, out=self._square)
+        self._integrate(self._square, self._squares[1:, 1:])
+
+    def _integrate(self, values, table):
+        # 2D cumulative sum with both passes along contiguous memory: a cumsum
+        # within each row, then each row added onto the next
+        np.cumsum(values, axis=1, dtype=self.dtype, out=table)
+        for i in range(1, table.shape[0]):
+            np.add(table[i], table[i - 1], out=table[i])
+
+    def box_sums(self, table, boxes):
+        x0, x1, y0, y1 = boxes.T
+        return table[x1, y1] - table[x0, y1] - table[x1, y0] + table[x0, y0]
+
+    def box_stats(self, boxes):
+        """
+        Statistics for boxes given as rows of (x0, x1, y0, y1), as returned by
+        ROIMask.bounds. Min and max are not available from the tables and are NaN.
+        """
+        boxes = np.asarray(boxes, dtype=np.intp).reshape(-1, 4)
+        counts = (boxes[:, 1] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 2])
+        sums = self.box_sums(self.sum_table, boxes).astype(np.float64)
+        squares = self.box_sums(self.square_table, boxes).astype(np.float64)
+
+        safe_counts = np.maximum(counts, 1)
+        means = sums / safe_counts
+        stds = np.sqrt(np.maximum(squares / safe_counts - means**2, 0.0))
+
+        return [
+            ROIStats(total, mean, std, np.nan, np.nan, int(count))
+            if count > 0
+            else EMPTY_STATS
+            for total, mean, std, count in zip(sums, means, stds, counts)
+        ]
+
+
+class SpotTracker:
+    """
+    Sub-pixel position and width of a spot within a search window.
+
+    Only the cutout around the given centre is read, so the cost depends on
+    the window size and not on the frame. The background and noise are the
+    median and MAD of the cutout's border pixels. A spot is only reported if
+    its peak is more than `detection` noise levels above the background and
+    it has at least `min_pixels` pixels above `threshold` noise levels around
+    the peak; a few noise spikes are not a spot. The spot is measured in a
+    box one and a half times its half-maximum width either side of the
+    peak, taken from three-pixel bands through the peak so one noisy row or
+    column can't size it. The position is the centroid of the pixels in the
+    box above the background and the width the full width at half maximum
+    of the x and y profiles, or both come from Gaussian fits to the
+    profiles (a weighted parabola fit to the log of each profile), falling
+    back to the centroid and half-maximum width when a fit fails. A
+    measurement without a clear half maximum is dropped (None) rather than
+    reported.
+    """
+
+    def __init__(self, method=TRACK_CENTROID, threshold=3.0, detection=5.0, min_pixels=4):
+        self.method = method
+        self.threshold = threshold
+        self.detection = detection
+        self.min_pixels = min_pixels
+
+    def locate(self, frame, center, radius):
+        """
+        SpotFit for the spot within `radius` pixels of `center` (frame index
+        coordinates), or None if no spot is detected above the background.
+        """
+        x0 = max(int(np.floor(center[0] - radius)), 0)
+        x1 = min(int(np.ceil(center[0] + radius)), frame.shape[0])
+        y0 = max(int(np.floor(center[1] - radius)), 0)
+        y1 = min(int(np.ceil(center[1] + radius)), frame.shape[1])
+        if x1 - x0 < 3 or y1 - y0 < 3:
+            return None
+        cutout = frame[x0:x1, y0:y1]
+
+        border = np.concatenate(
+            [cutout[0], cutout[-1], cutout[1:-1, 0], cutout[1:-1, -1]]
+        ).astype(np.float64)
+        background = np.median(border)
+        # At least 1 count of noise, as integer frames can have a MAD of 0
+        noise = max(1.4826 * np.median(np.abs(border - background)), 1.0)
+        weights = cutout.astype(np.float64)
+        weights -= background
+
+        # Detection: a significant peak with enough bright pixels around it
+        peak = np.unravel_index(np.argmax(weights), weights.shape)
+        if weights[peak] <= self.detection * noise:
+            return None
+        mask = weights > self.threshold * noise
+        around = mask[
+            max(peak[0] - 1, 0) : peak[0] + 2, max(peak[1] - 1, 0) : peak[1] + 2
+        ]
+        if np.count_nonzero(around) < min(self.min_pixels, around.size):
+            return None
+        # The box is sized from the half-maximum width of the profiles of
+        # three-pixel bands through the peak, which are steady even when the
+        # pixels at the threshold are not. Every pixel in the box is then
+        # weighted by its value above the background: masking or clipping
+        # the weights would cut or lift the wings and bias the width, and the
+        # noise in the box averages out.
+        band_x = weights[:, max(peak[1] - 1, 0) : peak[1] + 2].sum(axis=1)
+        band_y = weights[max(peak[0] - 1, 0) : peak[0] + 2].sum(axis=0)
+        width = max(_half_max_width(band_x), _half_max_width(band_y))
+        if not np.isfinite(width):
+            return None
+        half = max(int(np.ceil(1.5 * width)), 2)
+        bx0, by0 = max(peak[0] - half, 0), max(peak[1] - half, 0)
+        weights = weights[bx0 : peak[0] + half + 1, by0 : peak[1] + half + 1]
+
+        profile_x = weights.sum(axis=1)
+        profile_y = weights.sum(axis=0)
+        signal = profile_x.sum()
+        if signal <= 0:
+            return None
+        xs = np.arange(x0 + bx0, x0 + bx0 + weights.shape[0]) + 0.5
+        ys = np.arange(y0 + by0, y0 + by0 + weights.shape[1]) + 0.5
+        x = np.dot(xs, profile_x) / signal
+        y = np.dot(ys, profile_y) / signal
+        fwhm_x = _half_max_width(profile_x)
+        fwhm_y = _half_max_width(profile_y)
+        if not (np.isfinite(fwhm_x) and np.isfinite(fwhm_y)):
+            return None
+        if self.method == TRACK_GAUSSIAN:
+            x, sigma_x = _gaussian_fit(xs, profile_x, x, fwhm_x / FWHM_PER_SIGMA)
+            y, sigma_y = _gaussian_fit(ys, profile_y, y, fwhm_y / FWHM_PER_SIGMA)
+            fwhm_x, fwhm_y = FWHM_PER_SIGMA * sigma_x, FWHM_PER_SIGMA * sigma_y
+        return SpotFit(x, y, fwhm_x, fwhm_y, signal)
+
+
+def _half_max_width(profile):
+    # Full width at half maximum of a profile in pixels, interpolating the
+    # crossings linearly, or NaN if it doesn't fall to half on both sides
+    peak = int(np.argmax(profile))
+    half = profile[peak] / 2
+    if half <= 0:
+        return np.nan
+    left = np.flatnonzero(profile[:peak] <= half)
+    right = np.flatnonzero(profile[peak:] <= half)
+    if not len(left) or not len(right):
+        return np.nan
+    i = left[-1]  # Last point at or below half before the peak
+    j = peak + right[0]  # First point at or below half after it
+    start = i + (half - profile[i]) / (profile[i + 1] - profile[i])
+    stop = j - 1 + (profile[j - 1] - half) / (profile[j - 1] - profile[j])
+    return stop - start
+
+
+def _gaussian_fit(positions, profile, mean, sigma):
+    # Fit ln(profile) with a parabola, weighted by the profile squared
+    # (Caruana's method), over the points above a fifth of the peak. Returns
+    # the given mean and sigma unchanged if the fit fails.
+    use = profile > 0.2 * profile.max()
+    if np.count_nonzero(use) < 3:
+        return mean, sigma
+    offset = positions[use] - mean  # Centred for a well-conditioned fit
+    try:
+        c2, c1, _ = np.polyfit(offset, np.log(profile[use]), 2, w=profile[use])
+    except (np.linalg.LinAlgError, ValueError):
+        return mean, sigma
+    if c2 >= 0:
+        return mean, sigma
+    return mean - c1 / (2 * c2), np.sqrt(-1 / (2 * c2))
+
+
+def image_centroid(image):
+    """
+    Intensity-weighted centroid (x, y) of the brightest spot in a row-major
+    image, in pixel coordinates with pixel centres at +0.5. Only pixels above
+    half way from the median level to the peak are weighted, so a large
+    background (even a sloping one) doesn't pull the centroid off the spot.
+    """
+    image = np.asarray(image)
+    # The median of a subsample is plenty for the background level
+    background = np.median(image[::4, ::4])
+    weights = image - (background + image.max()) / 2
+    np.maximum(weights, 0, out=weights)
+    total = weights.sum()
+    if total == 0:
+        return image.shape[1] / 2, image.shape[0] / 2
+    x = np.dot(weights.sum(axis=0), np.arange(image.shape[1]) + 0.5) / total
+    y = np.dot(weights.sum(axis=1), np.arange(image.shape[0]) + 0.5) / total
+    return x, y
+
+
+class EncircledEnergy:
+    """
+    Encircled energy curve EE(r) and radial profile of a row-major image.
+
+    Pixels are binned by the distance of their centres from the centre, in
+    steps of `bin_width` pixels, and summed per annulus with one bincount;
+    the cumulative sum is then the energy inside every radius at once, so
+    reading it off for any radius is a lookup. The curve can be cut off at a
+    maximum radius, so only the cutout around the centre is read and moving
+    the centre costs O(max_radius^2) however large the image. The bin of
+    each pixel is cached and only recomputed when the centre, maximum radius
+    or image shape changes; the image total is summed once per image.
+
+    A background plane a + b x + c y is corrected for analytically: the
+    summed pixel x and y coordinates within each radius are cached with the
+    radius map, so the plane's sum within every radius is exact (even where
+    the annuli run off the image) and costs O(annuli), not O(image).
+    """
+
+    def __init__(self, bin_width=0.5):
+        self.bin_width = bin_width
+        self.image = None
+        self.shape = None
+        self.center = None
+        self.max_radius = np.inf
+        self._window = None  # (rows, columns) slices of the cutout
+        self._bins = None  # Annulus of each cutout pixel, flattened
+        self.edges = None  # Outer radius of each annulus
+        self.counts = None  # Pixels in each annulus
+        self.area = None  # Pixels within each outer radius
+        self._x_sums = None  # Summed pixel x within each outer radius
+        self._y_sums = None  # Summed pixel y within each outer radius
+        self._image_sums = None  # Pixels, summed x and summed y of the image
+        self.sums = None  # Image sum over each annulus
+        self.energy = None  # Image sum within each outer radius
+        self.profile = None  # Mean pixel value in each annulus
+        self.total = 0.0  # Sum of the whole image
+
+    def set_image(self, image):
+        # New image: sum it once, for the totals of every later curve
+        self.image = image
+        height, width = image.shape
+        self.total = float(np.sum(image, dtype=np.float64))
+        self._image_sums = (height * width, height * width**2 / 2, width * height**2 / 2)
+
+    def set_center(self, shape, center, max_radius=None):
+        # Rebuild the radius map if the centre, maximum radius or image shape
+        # changed
+        center = (float(center[0]), float(center[1]))
+        max_radius = np.inf if max_radius is None else float(max_radius)
+        if (tuple(shape), center, max_radius) == (self.shape, self.center, self.max_radius):
+            return
+        self.shape = tuple(shape)
+        self.center = center
+        self.max_radius = max_radius
+        if np.isfinite(max_radius):
+            x0 = min(max(int(np.floor(center[0] - max_radius)), 0), shape[1])
+            x1 = max(min(int(np.ceil(center[0] + max_radius)), shape[1]), x0)
+            y0 = min(max(int(np.floor(center[1] - max_radius)), 0), shape[0])
+            y1 = max(min(int(np.ceil(center[1] + max_radius)), shape[0]), y0)
+        else:
+            x0, x1, y0, y1 = 0, shape[1], 0, shape[0]
+        self._window = (slice(y0, y1), slice(x0, x1))
+        dy = np.arange(y0, y1) + 0.5 - center[1]
+        dx = np.arange(x0, x1) + 0.5 - center[0]
+        radius = np.hypot(dy[:, None], dx[None, :])
+        self._bins = (radius / self.bin_width).astype(np.intp).ravel()
+        if np.isfinite(max_radius):
+            # Annuli beyond the maximum radius run out of the cutout
+            size = max(int(max_radius / self.bin_width), 1)
+        else:
+            size = int(self._bins.max()) + 1 if self._bins.size else 1
+        self.counts = np.bincount(self._bins, minlength=size)[:size]
+        self.edges = np.arange(1, size + 1) * self.bin_width
+        self.area = np.cumsum(self.counts)
+        x = np.broadcast_to(dx + center[0], radius.shape).ravel()
+        y = np.broadcast_to((dy + center[1])[:, None], radius.shape).ravel()
+        self._x_sums = np.cumsum(np.bincount(self._bins, weights=x, minlength=size)[:size])
+        self._y_sums = np.cumsum(np.bincount(self._bins, weights=y, minlength=size)[:size])
+
+    def update(self, center=None, max_radius=None):
+        """
+        Compute the curve for the image (see set_image) about `center`
+        (x, y), by default its centroid, out to `max_radius` (by default
+        the whole image).
+        """
+        if center is None:
+            center = image_centroid(self.image)
+        self.set_center(self.image.shape, center, max_radius)
+        size = len(self.counts)
+        self.sums = np.bincount(
+            self._bins, weights=np.ravel(self.image[self._window]), minlength=size
+        )[:size]
+        self.energy = np.cumsum(self.sums)
+        self.profile = self.sums / np.maximum(self.counts, 1)
+
+    def background_energy(self, coefficients):
+        # Sum of the plane a + b x + c y within each outer radius
+        a, b, c = coefficients
+        return a * self.area + b * self._x_sums + c * self._y_sums
+
+    def corrected(self, coefficients):
+        """
+        (energy, profile, total) with the background plane `coefficients`
+        (a, b, c) subtracted.
+        """
+        a, b, c = coefficients
+        pixels, x_sum, y_sum = self._image_sums
+        background = self.background_energy(coefficients)
+        energy = self.energy - background
+        profile = (self.sums - np.diff(background, prepend=0)) / np.maximum(self.counts, 1)
+        total = self.total - (a * pixels + b * x_sum + c * y_sum)
+        return energy, profile, total
+
+    def energy_at(self, radius, energy=None):
+        # Image sum (or the given energy curve) within `radius`, interpolated
+        # between annuli
+        if energy is None:
+            energy = self.energy
+        return np.interp(radius, np.r_[0, self.edges], np.r_[0, energy])
+
+    def area_at(self, radius):
+        # Pixel count within `radius`, interpolated between annuli
+        return np.interp(radius, np.r_[0, self.edges], np.r_[0, self.area])
+
+    def to_csv(self, path, coefficients=(0.0, 0.0, 0.0)):
+        # Curve and profile, with a background plane subtracted
+        energy, profile, total = self.corrected(coefficients)
+        fraction = energy / total if total else np.zeros_like(energy)
+        np.savetxt(
+            path,
+            np.column_stack([self.edges, self.area, profile, energy, fraction]),
+            delimiter=",",
+            header="radius,pixels,profile,encircled_energy,fraction",
+            comments="",
+        )
+
+
+class BackgroundModel:
+    """
+    Background level of a row-major image: a constant, or a plane
+    a + b x + c y, fitted to the pixels of a rectangular region.
+
+    Only the region is read, so refitting while its ROI is dragged costs
+    O(region) however large the image. On the regular pixel grid of a
+    rectangle the centred x and y coordinates are orthogonal, so the plane
+    fit is three sums rather than a general least-squares solve.
+    """
+
+    def __init__(self, plane=False):
+        self.plane = plane
+        self.coefficients = (0.0, 0.0, 0.0)  # a, b, c
+
+    def fit(self, image, x0, x1, y0, y1):
+        """
+        Fit the pixels in columns [x0, x1) and rows [y0, y1). Returns False
+        if the region holds no pixels.
+        """
+        x0, x1 = max(int(x0), 0), min(int(x1), image.shape[1])
+        y0, y1 = max(int(y0), 0), min(int(y1), image.shape[0])
+        if x1 <= x0 or y1 <= y0:
+            return False
+        region = np.asarray(image[y0:y1, x0:x1], dtype=np.float64)
+        level = region.mean()
+        if not self.plane:
+            self.coefficients = (level, 0.0, 0.0)
+            return True
+        # Pixel centres relative to the centre of the region
+        dx = np.arange(x0, x1) + 0.5 - (x0 + x1) / 2
+        dy = np.arange(y0, y1) + 0.5 - (y0 + y1) / 2
+        b = np.dot(region.sum(axis=0), dx) / (len(dy) * np.dot(dx, dx)) if len(dx) > 1 else 0.0
+        c = np.dot(region.sum(axis=1), dy) / (len(dx) * np.dot(dy, dy)) if len(dy) > 1 else 0.0
+        a = level - b * (x0 + x1) / 2 - c * (y0 + y1) / 2
+        self.coefficients = (a, b, c)
+        return True
+
+    def value_at(self, x, y):
+        a, b, c = self.coefficients
+        return a + b * x + c * y
+
+
+def frame_histogram(frame, bins=256, max_value=65535, stride=1):
+    """
+    Histogram of a frame with at most `bins` bins over [0, max_value], using
+    every `stride`-th pixel along each axis. Returns (bin_edges, counts) with
+    edges at the left of each bin.
+    """
+    # Bin width is a power of two so binning is a shift rather than a division
+    shift = max(int(np.ceil(np.log2((max_value + 1) / bins))), 0)
+    nbins = (int(max_value) >> shift) + 1
+
+    sample = frame[::stride, ::stride]
+    if not np.issubdtype(sample.dtype, np.integer):
+        # Stacked or calibrated frames are floating point
+        sample = np.clip(sample, 0, max_value).astype(np.uint32)
+    counts = np.bincount((sample >> shift).ravel(), minlength=nbins)[:nbins]
+    return np.arange(nbins) << shift, counts
+
+
+class FrameHistogram:
+    """
+    Histogram stage for the HistogramLUT. The result is cached until the next
+    update, so it can be refreshed at a lower rate than the display and its
+    cost tuned with the subsampling stride.
+    """
+
+    def __init__(self, bins=256, stride=4, max_value=65535):
+        self.bins = bins
+        self.stride = stride
+        self.max_value = max_value
+        self.histogram = None  # (bin_edges, counts)
+
+    def update(self, frame):
+        self.histogram = frame_histogram(
+            frame, bins=self.bins, max_value=self.max_value, stride=self.stride
+        )
+        return self.histogram
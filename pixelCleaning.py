@@ -0,0 +1,172 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def hot_pixel_map(dark, sigma=5.0):
+    """
+    Boolean map of the hot pixels of a master dark: those more than `sigma`
+    robust standard deviations (from the median absolute deviation) above
+    its median.
+    """
+    median = np.median(dark)
+    spread = 1.4826 * np.median(np.abs(dark - median))
+    if spread == 0:
+        spread = np.std(dark)
+    return dark > median + sigma * max(spread, 1.0)
+
+
+class PixelCleaner:
+    """
+    Replaces hot pixels and cosmic-ray hits in each frame, in place.
+
+    Pixels on a static hot-pixel map are replaced by the mean of their four
+    neighbours. Every other pixel is compared with an exponentially weighted
+    running mean and variance of its own history, and replaced by the
+    running mean when it is more than `sigma` standard deviations above it.
+    A pixel that stays high on the next frame is a real change in the signal
+    rather than a one-frame hit, so it is kept and the running mean follows
+    it. The frame is split into bands of rows that are cleaned in parallel on
+    a thread pool (NumPy releases the GIL), each with a fixed number of
+    vectorised passes; the rejection limit is refreshed from the variance
+    every `limit_every` frames.
+    """
+
+    def __init__(self, sigma=5.0, span=32, warmup=8, limit_every=4, threads=None):
+        self.sigma = sigma
+        self.alpha = 2 / (span + 1)
+        self.warmup = warmup  # Frames to learn the running statistics from
+        self.limit_every = limit_every  # Frames between rejection limit updates
+        self.threads = threads or min(os.cpu_count() or 1, 4)
+        self.executor = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+
+        self.hot_pixels = None  # (rows, columns) of the static hot pixels
+        self.neighbours = None
+        self.shape = None
+        self.count = 0
+        # Pixels replaced in the last frame, and how many of each kind
+        self.replaced = None
+        self.hot_replaced = 0
+        self.outliers_replaced = 0
+
+    def set_hot_pixels(self, hot_map):
+        """
+        Set the static hot-pixel map (a boolean array in frame order), or
+        clear it with None.
+        """
+        if hot_map is None or not hot_map.any():
+            self.hot_pixels = None
+            self.neighbours = None
+            return
+        rows, columns = np.nonzero(hot_map)
+        height, width = hot_map.shape
+        self.hot_pixels = (rows, columns)
+        # Flat indices of the four neighbours, clamped at the edges
+        self.neighbours = np.stack(
+            [
+                np.clip(rows - 1, 0, height - 1) * width + columns,
+                np.clip(rows + 1, 0, height - 1) * width + columns,
+                rows * width + np.clip(columns - 1, 0, width - 1),
+                rows * width + np.clip(columns + 1, 0, width - 1),
+            ]
+        )
+
+    def reset(self):
+        # Forget the running statistics; relearned over the next frames
+        self.shape = None
+        self.count = 0
+
+    def _allocate(self, shape):
+        self.shape = shape
+        self.count = 0
+        self.mean = np.zeros(shape, dtype=np.float32)
+        self.variance = np.zeros(shape, dtype=np.float32)
+        self.limit = np.zeros(shape, dtype=np.float32)  # sigma * std
+        self.replaced = np.zeros(shape, dtype=bool)
+        self._delta = np.empty(shape, dtype=np.float32)
+        self._square = np.empty(shape, dtype=np.float32)
+        self._candidate = np.zeros(shape, dtype=bool)
+        self._previous = np.zeros(shape, dtype=bool)
+        rows = -(-shape[0] // self.threads)
+        self._bands = [slice(i, i + rows) for i in range(0, shape[0], rows)]
+
+    def clean(self, frame):
+        """
+        Clean a frame (in sensor order) in place. Returns the frame.
+        """
+        if frame.shape != self.shape:
+            self._allocate(frame.shape)
+        if self.hot_pixels is not None and self.hot_pixels[0].max() >= frame.shape[0]:
+            # Map from another frame geometry
+            self.set_hot_pixels(None)
+        if self.hot_pixels is not None:
+            values = frame.reshape(-1)[self.neighbours].astype(np.float32)
+            frame[self.hot_pixels] = values.mean(axis=0)
+
+        self.count += 1
+        self._frame = frame
+        if self.executor is not None:
+            counts = list(self.executor.map(self._clean_band, self._bands))
+        else:
+            counts = [self._clean_band(band) for band in self._bands]
+        self._frame = None
+        self.outliers_replaced = sum(counts)
+
+        if self.hot_pixels is not None:
+            self.replaced[self.hot_pixels] = True
+            self.hot_replaced = len(self.hot_pixels[0])
+        else:
+            self.hot_replaced = 0
+        return frame
+
+    def _clean_band(self, band):
+        # Temporal outlier rejection over one band of rows. Returns the number
+        # of pixels replaced.
+        frame = self._frame[band]
+        mean = self.mean[band]
+        variance = self.variance[band]
+        limit = self.limit[band]
+        delta = self._delta[band]
+        square = self._square[band]
+        candidate = self._candidate[band]
+        previous = self._previous[band]
+        replaced = self.replaced[band]
+
+        np.subtract(frame, mean, out=delta)
+        if self.count <= self.warmup:
+            # Plain average over the first frames, nothing rejected yet
+            alpha = 1 / self.count
+            replaced[...] = False
+            count = 0
+        else:
+            alpha = self.alpha
+            np.greater(delta, limit, out=candidate)
+            # Only a pixel that wasn't high on the last frame too is a hit
+            # (candidate and not previous)
+            np.greater(candidate, previous, out=replaced)
+            np.copyto(previous, candidate)
+            count = int(np.count_nonzero(replaced))
+            if count:
+                frame[replaced] = mean[replaced]
+                delta[replaced] = 0
+
+        # Exponentially weighted mean and variance:
+        # var = (1 - alpha) * (var + alpha * delta^2)
+        np.multiply(delta, alpha, out=square)
+        mean += square
+        delta *= square
+        variance += delta
+        variance *= 1 - alpha
+        if self.count % self.limit_every == 0 or self.count <= self.warmup:
+            # The variance changes slowly, so the limit needn't follow it
+            # every frame
+            np.add(variance, 1, out=limit)  # At least 1 count of noise
+            np.sqrt(limit, out=limit)
+            limit *= self.sigma
+        return count
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
@@ -0,0 +1,156 @@
+import os
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from imgAnalysis import ROIMask, IntegralImage, EMPTY_STATS, frame_histogram
+
+# Result record posted back to the GUI for one frame
+StatsResult = namedtuple("StatsResult", ["frame", "roi_stats", "histogram"])
+
+# Per-process worker state: the attached shared memory block plus cached
+# ROI masks and integral image, so masks are only rebuilt when an ROI moves
+_shm = None
+_masks = {}
+_integral = IntegralImage()
+
+
+def _frame_view(name, slot, shape, dtype, transposed):
+    global _shm
+    if _shm is None or _shm.name != name:
+        if _shm is not None:
+            _shm.close()
+        _shm = shared_memory.SharedMemory(name=name)
+    stored = shape[::-1] if transposed else shape
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    frame = np.ndarray(stored, dtype=dtype, buffer=_shm.buf, offset=slot * nbytes)
+    return frame.T if transposed else frame
+
+
+def _roi_job(name, slot, shape, dtype, transposed, rois, integral):
+    # ROI statistics for one frame. rois is a list of (elliptical, pos, size).
+    frame = _frame_view(name, slot, shape, dtype, transposed)
+    masks = []
+    for i, (elliptical, pos, size) in enumerate(rois):
+        mask = _masks.get((i, elliptical))
+        if mask is None:
+            mask = _masks[(i, elliptical)] = ROIMask(elliptical=elliptical)
+        mask.set_geometry(pos, size)
+        masks.append(mask)
+
+    boxes = [mask.bounds(frame.shape) for mask in masks if not mask.elliptical]
+    if integral and boxes and IntegralImage.pays_off(boxes, frame.shape):
+        # Rectangles from the summed-area tables, ellipses from their masks
+        _integral.update(frame)
+        box_stats = iter(_integral.box_stats(boxes))
+        return [
+            mask.stats(frame) if mask.elliptical else next(box_stats, EMPTY_STATS)
+            for mask in masks
+        ]
+    return [mask.stats(frame) for mask in masks]
+
+
+def _histogram_job(name, slot, shape, dtype, transposed, bins, max_value, stride):
+    frame = _frame_view(name, slot, shape, dtype, transposed)
+    return frame_histogram(frame, bins=bins, max_value=max_value, stride=stride)
+
+
+class StatsWorkerPool:
+    """
+    Process pool computing ROI statistics and histograms off the GUI thread.
+
+    Frames are copied once into a shared memory block with a fixed number of
+    slots; workers attach to it by name and post back only small result
+    records. If every slot is busy the frame is skipped rather than queued.
+    """
+
+    def __init__(self, workers=None, slots=None, hist_bins=256, hist_stride=1):
+        self.workers = workers or max((os.cpu_count() or 2) - 1, 1)
+        self.slots = slots or 2 * self.workers
+        self.hist_bins = hist_bins
+        self.hist_stride = hist_stride
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        self._shm = None
+        self._shape = None
+        self._dtype = None
+        self._transposed = False
+        self._frames = []
+        self._free = deque()
+        self._pending = deque()  # (frame info, slot, roi future, histogram future)
+
+        # Counters
+        self.submitted = 0
+        self.skipped = 0
+
+    def _allocate(self, frame):
+        # (Re)create the shared memory block for a new frame shape
+        self._release_shm()
+        self._shape = frame.shape
+        self._dtype = frame.dtype
+        # Store frames in their memory order so the copy in is a straight memcpy
+        self._transposed = frame.flags.f_contiguous and not frame.flags.c_contiguous
+        stored = frame.shape[::-1] if self._transposed else frame.shape
+        nbytes = frame.nbytes
+        self._shm = shared_memory.SharedMemory(create=True, size=nbytes * self.slots)
+        self._frames = [
+            np.ndarray(stored, dtype=frame.dtype, buffer=self._shm.buf, offset=i * nbytes)
+            for i in range(self.slots)
+        ]
+        self._free = deque(range(self.slots))
+
+    def submit(self, frame, rois, info=None, integral=False, max_value=65535):
+        """
+        Queue a frame for analysis. `info` (e.g. the frame's metadata) is
+        returned with its result. Returns False if the frame was skipped.
+        """
+        if frame.shape != self._shape or frame.dtype != self._dtype:
+            if self._pending:
+                # Wait for in-flight jobs before reallocating their memory
+                self.skipped += 1
+                return False
+            self._allocate(frame)
+        if not self._free:
+            self.skipped += 1
+            return False
+
+        slot = self._free.popleft()
+        np.copyto(self._frames[slot], frame.T if self._transposed else frame)
+        args = (self._shm.name, slot, self._shape, self._dtype.str, self._transposed)
+        roi_future = self.executor.submit(_roi_job, *args, rois, integral)
+        hist_future = self.executor.submit(
+            _histogram_job, *args, self.hist_bins, max_value, self.hist_stride
+        )
+        self._pending.append((info, slot, roi_future, hist_future))
+        self.submitted += 1
+        return True
+
+    def results(self):
+        """
+        Collect finished results, in frame order.
+        """
+        finished = []
+        while self._pending:
+            info, slot, roi_future, hist_future = self._pending[0]
+            if not (roi_future.done() and hist_future.done()):
+                break
+            self._pending.popleft()
+            self._free.append(slot)
+            finished.append(
+                StatsResult(info, roi_future.result(), hist_future.result())
+            )
+        return finished
+
+    def _release_shm(self):
+        if self._shm is not None:
+            self._frames = []
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self._pending.clear()
+        self._release_shm()
@@ -0,0 +1,229 @@
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+
+class TimeSeriesBuffer:
+    """
+    Fixed-capacity store of (time, value) samples, oldest first.
+
+    Every sample is written twice, at i and i + capacity of arrays twice the
+    capacity long, so the newest `capacity` samples are always a contiguous
+    slice. Appending is O(1), reading is a view with no copy, and memory stays
+    fixed however long the session runs.
+    """
+
+    def __init__(self, capacity=100000, dtype=np.float64):
+        self.capacity = capacity
+        self._times = np.zeros(2 * capacity)
+        self._values = np.zeros(2 * capacity, dtype=dtype)
+        self._next = 0  # Slot the next sample goes into
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, t, value):
+        i = self._next
+        self._times[i] = self._times[i + self.capacity] = t
+        self._values[i] = self._values[i + self.capacity] = value
+        self._next = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def clear(self):
+        self._next = 0
+        self.count = 0
+
+    def data(self, window=None):
+        """
+        (times, values) views of the stored samples, oldest first. With a
+        window (in the units of the times) only the most recent samples
+        within `window` of the newest one are returned.
+        """
+        stop = self._next + self.capacity
+        start = stop - self.count
+        times = self._times[start:stop]
+        values = self._values[start:stop]
+        if window is not None and self.count:
+            # Times are in increasing order, so the cut is a binary search
+            first = np.searchsorted(times, times[-1] - window)
+            times = times[first:]
+            values = values[first:]
+        return times, values
+
+
+# One record of a DecimationPyramid level: start time of the bucket and the
+# min, max and mean of the `count` samples in it (a raw sample at level 0)
+HISTORY_DTYPE = np.dtype(
+    [
+        ("time", "<f8"),
+        ("min", "<f8"),
+        ("max", "<f8"),
+        ("mean", "<f8"),
+        ("count", "<i8"),
+    ]
+)
+HISTORY_RECORD = struct.Struct("<ddddq")
+
+
+class DecimationPyramid:
+    """
+    Min/max/mean summaries of a time series at several resolutions, kept on
+    disk so histories can grow for as long as the session runs.
+
+    Level 0 is the raw samples, of which only the newest `recent` are kept,
+    in memory; each bucket of level k summarises `factor` buckets of level
+    k - 1. Buckets are completed incrementally as samples arrive and
+    appended to one file per level (1 and up), flushed every
+    `flush_interval` seconds, so memory use is constant, the disk grows by a
+    record per `factor` samples, and any time range can be drawn from the
+    level with about as many records as there are pixels to draw them on.
+    The buckets still being filled are included at the end of each query,
+    so the newest data is shown at every level.
+    """
+
+    def __init__(self, directory, factor=8, levels=6, recent=100000, flush_interval=1.0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        info_path = os.path.join(directory, "pyramid.json")
+        # Whether the raw samples in memory are the whole history (until the
+        # oldest start being dropped)
+        self._new = not os.path.exists(info_path)
+        if os.path.exists(info_path):
+            # Continue (or just view) an existing history
+            with open(info_path) as file:
+                info = json.load(file)
+            factor, levels = info["factor"], info["levels"]
+        else:
+            with open(info_path, "w") as file:
+                json.dump({"factor": factor, "levels": levels}, file)
+        self.factor = factor
+        self.levels = levels
+        self.recent = TimeSeriesBuffer(capacity=recent)
+        self.flush_interval = flush_interval
+        self._last_flush = time.perf_counter()
+
+        # Level 0 is only in memory, so there is no file for it
+        self._files = [None] + [open(self.level_path(k), "ab") for k in range(1, levels)]
+        # Bucket being filled at each level:
+        # [start time, min, max, sum, sample count, child count]
+        self._partial = [None] * levels
+
+    def level_path(self, level):
+        return os.path.join(self.directory, f"level{level}.bin")
+
+    def append(self, t, value):
+        value = float(value)
+        self.recent.append(t, value)
+        self._add(1, t, value, value, value, 1)
+        now = time.perf_counter()
+        if now - self._last_flush >= self.flush_interval:
+            self._last_flush = now
+            self.flush()
+
+    def _add(self, level, t, low, high, total, count):
+        # Fold a completed bucket of the level below into this level
+        if level >= self.levels:
+            return
+        partial = self._partial[level]
+        if partial is None:
+            partial = self._partial[level] = [t, low, high, total, count, 1]
+        else:
+            partial[1] = min(partial[1], low)
+            partial[2] = max(partial[2], high)
+            partial[3] += total
+            partial[4] += count
+            partial[5] += 1
+        if partial[5] == self.factor:
+            self._partial[level] = None
+            t, low, high, total, count, _ = partial
+            self._files[level].write(
+                HISTORY_RECORD.pack(t, low, high, total / count, count)
+            )
+            self._add(level + 1, t, low, high, total, count)
+
+    def flush(self):
+        for file in self._files[1:]:
+            file.flush()
+
+    def level(self, index):
+        """
+        All records of a level: the newest raw samples for level 0, otherwise
+        a read-only memmap of the completed buckets.
+        """
+        if index == 0:
+            times, values = self.recent.data()
+            records = np.zeros(len(times), dtype=HISTORY_DTYPE)
+            records["time"] = times
+            records["min"] = records["max"] = records["mean"] = values
+            records["count"] = 1
+            return records
+        self._files[index].flush()
+        path = self.level_path(index)
+        count = os.path.getsize(path) // HISTORY_DTYPE.itemsize
+        if count == 0:
+            return np.zeros(0, dtype=HISTORY_DTYPE)
+        return np.memmap(path, dtype=HISTORY_DTYPE, mode="r", shape=(count,))
+
+    def partial(self, index):
+        """
+        Summary of the samples since the last completed bucket of a level
+        (those still in the partial buckets of it and every level below), as
+        a one-record array, or an empty one if there are none.
+        """
+        buckets = [bucket for bucket in self._partial[1 : index + 1] if bucket is not None]
+        if index == 0 or not buckets:
+            return np.zeros(0, dtype=HISTORY_DTYPE)
+        count = sum(bucket[4] for bucket in buckets)
+        record = np.zeros(1, dtype=HISTORY_DTYPE)
+        record["time"] = min(bucket[0] for bucket in buckets)
+        record["min"] = min(bucket[1] for bucket in buckets)
+        record["max"] = max(bucket[2] for bucket in buckets)
+        record["mean"] = sum(bucket[3] for bucket in buckets) / count
+        record["count"] = count
+        return record
+
+    def query(self, t0, t1, max_points=2000):
+        """
+        (level, records) for the time range [t0, t1] from the finest level
+        with at most `max_points` records in it. One record either side of
+        the range is included so a plotted line runs to the edges. Level 0
+        is only used if the raw samples kept in memory reach back to t0.
+        """
+        for index in range(self.levels):
+            records = self.level(index)
+            if index == 0:
+                whole = self._new and len(self.recent) < self.recent.capacity
+                if len(records) == 0 or (not whole and records["time"][0] > t0):
+                    continue
+            times = records["time"]
+            first = _search(times, t0)
+            last = _search(times, t1)
+            if last - first <= max_points or index == self.levels - 1:
+                first = max(first - 1, 0)
+                if last >= len(records):
+                    # The range runs to the newest data, which is still being
+                    # summarised
+                    records = np.concatenate([records[first:], self.partial(index)])
+                    return index, records
+                return index, np.array(records[first : last + 1])
+
+    def close(self):
+        for file in self._files[1:]:
+            file.close()
+
+
+def _search(times, t):
+    # Binary search of a sorted (strided, memory-mapped) column. Unlike
+    # np.searchsorted this only reads the elements it compares against.
+    low, high = 0, len(times)
+    while low < high:
+        middle = (low + high) // 2
+        if times[middle] < t:
+            low = middle + 1
+        else:
+            high = middle
+    return low
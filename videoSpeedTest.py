@@ -0,0 +1,248 @@
+"""
+Headless benchmark of the per-frame processing in zwoImage_pyqtgraph.py.
+
+Builds a CameraControlGUI on the simulated sensor without showing it, stops
+its capture thread and feeds it frames directly, timing each call to
+process_frame: the bit-depth shift, rectangle/circle ROI statistics, net
+counts, the net counts history and, optionally, frame stacking. Runs over
+several binnings and ROI counts and reports frames/s, the per-frame latency
+distribution and peak RSS. Each case runs in its own process, in a temporary
+working directory, so the peak RSS is the case's own and the history it
+records on disk is removed afterwards.
+
+    python videoSpeedTest.py                          # run and print results
+    python videoSpeedTest.py --save baseline.json     # store a baseline
+    python videoSpeedTest.py --compare baseline.json  # compare to a baseline
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# No window is needed, so don't require a display
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PySide6.QtWidgets import QApplication
+
+from frameBuffer import FrameRecord
+from virtualCameras import SimulatedCamera
+import zwoImage_pyqtgraph as zwo
+
+BINS = (1, 2, 4)
+ROI_COUNTS = (1, 4, 16)
+
+
+def peak_rss_mb():
+    # Peak resident set size of this process so far, in MB (each case runs in
+    # a fresh process, so this is the peak for the case)
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in bytes on macOS and in kB elsewhere
+        return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+    except ImportError:
+        # Windows has no resource module
+        import psutil
+
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / 1e6
+
+
+def make_gui(camera, rois, integral=False, history=True, stack=None):
+    # GUI with its capture thread and timers stopped, fed by the benchmark
+    gui = zwo.CameraControlGUI(camera)
+    gui.frame_capture_thread.stop()
+    gui.display_timer.stop()
+    gui.histogram_timer.stop()
+    # The simulated sensor's frames are left-justified, so the GUI has to
+    # shift them down to the sensor's bit depth as it would for a camera
+    gui.bit_depth = camera.bit_depth
+    gui.division_factor = 2 ** (16 - camera.bit_depth)
+    gui.bit_shift = 16 - camera.bit_depth
+
+    for _ in range(rois - 1):
+        gui.add_rect_ROI()
+    gui.integral_checkbox.setChecked(integral)
+    gui.circle_ROI_net_counts_checkbox.setChecked(history)
+    if stack is not None:
+        # Stack and analyse the stacked image
+        gui.stack_selector.setCurrentText(stack)
+        gui.show_stacked_checkbox.setChecked(True)
+    return gui
+
+
+def run_case(bins, rois, frames=300, warmup=20, integral=False, history=True, stack=None):
+    """
+    Time process_frame on `frames` simulated frames. Returns a dict of results.
+    """
+    camera = SimulatedCamera(bins=bins, seed=0)
+    gui = make_gui(camera, rois, integral=integral, history=history, stack=stack)
+
+    # Raw frames are captured up front so only the GUI work is timed. Each
+    # one is copied into a work buffer first, since the shift is in place.
+    pool = [camera.capture_video_frame() for _ in range(16)]
+    work = np.empty_like(pool[0])
+
+    record = FrameRecord(work, exposure=camera.exposure, geometry=(0, 0, bins))
+
+    latencies = np.empty(frames)
+    for i in range(warmup + frames):
+        np.copyto(work, pool[i % len(pool)])
+        record.seq = i
+        record.timestamp = time.time()
+        start = time.perf_counter()
+        gui.process_frame(record)
+        if i >= warmup:
+            latencies[i - warmup] = time.perf_counter() - start
+
+    gui.close()
+    latencies *= 1e3  # ms
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    height, width = work.shape
+    return {
+        "bins": bins,
+        "rois": rois,
+        "width": width,
+        "height": height,
+        "frames": frames,
+        "fps": frames / (latencies.sum() / 1e3),
+        "mean_ms": latencies.mean(),
+        "p50_ms": p50,
+        "p90_ms": p90,
+        "p99_ms": p99,
+        "max_ms": latencies.max(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_case_process(bins, rois, args):
+    """
+    run_case in a fresh process with a temporary working directory, which is
+    removed afterwards. Returns the results dict.
+    """
+    with tempfile.TemporaryDirectory(prefix="videoSpeedTest_") as directory:
+        result_path = os.path.join(directory, "result.json")
+        command = [
+            sys.executable, os.path.abspath(__file__),
+            "--case", str(bins), str(rois),
+            "--result", result_path,
+            "--frames", str(args.frames),
+        ]
+        if args.integral:
+            command.append("--integral")
+        if args.no_history:
+            command.append("--no-history")
+        if args.stack:
+            command += ["--stack", args.stack]
+        # The GUI's own messages are not part of the results
+        subprocess.run(command, cwd=directory, check=True, stdout=subprocess.DEVNULL)
+        with open(result_path) as file:
+            return json.load(file)
+
+
+def case_name(result):
+    return f"bin{result['bins']}_rois{result['rois']}"
+
+
+def print_results(results, baseline=None):
+    print(
+        f"{'case':<14}{'size':>11}{'fps':>10}{'p50 ms':>9}{'p90 ms':>9}"
+        f"{'p99 ms':>9}{'max ms':>9}{'RSS MB':>9}"
+    )
+    for result in results:
+        line = (
+            f"{case_name(result):<14}"
+            f"{result['width']:>5}x{result['height']:<5}"
+            f"{result['fps']:>10.1f}{result['p50_ms']:>9.3f}{result['p90_ms']:>9.3f}"
+            f"{result['p99_ms']:>9.3f}{result['max_ms']:>9.3f}{result['peak_rss_mb']:>9.1f}"
+        )
+        if baseline is not None and case_name(result) in baseline:
+            # Relative to the baseline: >1 is faster
+            old = baseline[case_name(result)]
+            line += (
+                f"   fps x{result['fps'] / old['fps']:.2f}"
+                f", p50 x{old['p50_ms'] / result['p50_ms']:.2f}"
+            )
+        print(line)
+
+
+def save_baseline(path, results, args):
+    data = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.platform(),
+        "settings": {
+            "frames": args.frames,
+            "integral": args.integral,
+            "history": not args.no_history,
+            "stack": args.stack,
+        },
+        "cases": {case_name(result): result for result in results},
+    }
+    with open(path, "w") as file:
+        json.dump(data, file, indent=2)
+    print(f"Saved baseline to {path}")
+
+
+def load_baseline(path):
+    with open(path) as file:
+        data = json.load(file)
+    print(
+        f"Comparing to {path} ({data['created']}, numpy {data['numpy']}, "
+        f"{data['settings']})"
+    )
+    return data["cases"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Frame processing benchmark")
+    parser.add_argument("--frames", type=int, default=300, help="Timed frames per case")
+    parser.add_argument("--bins", type=int, nargs="+", default=BINS)
+    parser.add_argument("--rois", type=int, nargs="+", default=ROI_COUNTS,
+                        help="Numbers of rectangle ROIs")
+    parser.add_argument("--integral", action="store_true",
+                        help="Allow the integral image for the rectangle ROIs "
+                             "(used when it beats the masks)")
+    parser.add_argument("--no-history", action="store_true",
+                        help="Don't record the net counts history")
+    parser.add_argument("--stack", choices=["Cumulative", "Window", "EMA"],
+                        help="Stack frames and analyse the stacked image")
+    parser.add_argument("--save", help="Write the results to a JSON baseline")
+    parser.add_argument("--compare", help="Compare against a JSON baseline")
+    # Used by run_case_process to run a single case
+    parser.add_argument("--case", type=int, nargs=2, metavar=("BINS", "ROIS"),
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        app = QApplication(sys.argv)
+        result = run_case(
+            *args.case,
+            frames=args.frames,
+            integral=args.integral,
+            history=not args.no_history,
+            stack=args.stack,
+        )
+        with open(args.result, "w") as file:
+            json.dump(result, file)
+        sys.exit()
+
+    baseline = load_baseline(args.compare) if args.compare else None
+
+    results = []
+    for bins in args.bins:
+        for rois in args.rois:
+            results.append(run_case_process(bins, rois, args))
+    print_results(results, baseline)
+
+    if args.save:
+        save_baseline(args.save, results, args)
@@ -0,0 +1,407 @@
+import glob
+import os
+import time
+
+import numpy as np
+import zwoasi as asi
+
+from frameRecorder import FrameStack
+
+
+class ReplayCamera:
+    """
+    Stand-in for a zwoasi Camera that plays back a recorded session.
+
+    The source is a .frames file written by FrameRecorder or a directory of
+    FITS frames. In real-time mode frames are delivered at the recorded frame
+    intervals (or the exposure time if there are no timestamps), otherwise as
+    fast as the caller asks for them.
+    """
+
+    def __init__(self, source, realtime=True, loop=True):
+        self.source = source
+        self.realtime = realtime
+        self.loop = loop
+        self.default_timeout = -1
+
+        if os.path.isdir(source):
+            self._load_fits_directory(source)
+        else:
+            stack = FrameStack(source)
+            self.frames = stack.frames
+            self.metadata = stack.metadata
+            self.bit_depth = stack.bit_depth
+            self.timestamps = stack.metadata["timestamp"]
+        if len(self) == 0:
+            raise ValueError(f"No frames found in {source}")
+        self.height, self.width = self.shape
+
+        self.controls = {
+            asi.ASI_GAIN: 0,
+            asi.ASI_EXPOSURE: 100000,
+            asi.ASI_TEMPERATURE: 200,
+        }
+        self.index = 0
+        self.frames_served = 0
+        self._last_time = None  # When the previous frame was delivered
+
+    def _load_fits_directory(self, directory):
+        # FITS support is optional (astropy), and frames are read on demand
+        from astropy.io import fits
+
+        self.fits_files = sorted(
+            glob.glob(os.path.join(directory, "*.fits"))
+            + glob.glob(os.path.join(directory, "*.fit"))
+        )
+        self.frames = None
+        self.bit_depth = 16
+        self.timestamps = np.full(len(self.fits_files), np.nan)
+        self.metadata = None
+        self._fits = fits
+        if self.fits_files:
+            self._fits_shape = fits.getdata(self.fits_files[0]).shape
+
+    def __len__(self):
+        if self.frames is not None:
+            return len(self.frames)
+        return len(self.fits_files)
+
+    @property
+    def shape(self):
+        if self.frames is not None:
+            return self.frames.shape[1:]
+        return self._fits_shape
+
+    def frame(self, index):
+        if self.frames is not None:
+            return self.frames[index]
+        data = self._fits.getdata(self.fits_files[index])
+        return np.asarray(data, dtype=np.uint16)
+
+    def _frame_period(self, index):
+        # Time between this frame and the previous one in the recording
+        if index > 0:
+            period = self.timestamps[index] - self.timestamps[index - 1]
+            if np.isfinite(period) and period > 0:
+                return period
+        return self.get_control_value(asi.ASI_EXPOSURE)[0] / 1e6
+
+    def _wait(self, index, timeout):
+        # Pace playback to the recording when in real-time mode
+        if not self.realtime:
+            return
+        _wait_until(self, self._frame_period(index), timeout)
+
+    def capture_video_frame(self, buffer_=None, filename=None, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        if self.index >= len(self):
+            if not self.loop:
+                # No more frames: behave like a camera that never delivers
+                if timeout >= 0:
+                    time.sleep(timeout / 1000)
+                raise asi.ZWO_IOError("Replay finished", 11)
+            self.index = 0
+            self._last_time = None
+
+        self._wait(self.index, timeout)
+        frame = self.frame(self.index)
+        self.index += 1
+        self.frames_served += 1
+
+        if buffer_ is not None:
+            # Fill the supplied buffer like zwoasi does
+            out = np.frombuffer(buffer_, dtype=np.uint16).reshape(frame.shape)
+            np.copyto(out, frame)
+            return out
+        return np.array(frame)
+
+    def get_roi_format(self):
+        return [self.width, self.height, 1, asi.ASI_IMG_RAW16]
+
+    def get_camera_property(self):
+        return {
+            "MaxWidth": self.width,
+            "MaxHeight": self.height,
+            "BitDepth": self.bit_depth,
+            "ElecPerADU": 1.0,
+            "PixelSize": 1.0,
+        }
+
+    def set_control_value(self, control_type, value, auto=False):
+        self.controls[control_type] = value
+
+    def get_control_value(self, control_type):
+        # Recorded exposure and gain win over the requested ones, since that is
+        # what the frames were actually taken with
+        if self.metadata is not None and self.index > 0:
+            record = self.metadata[self.index - 1]
+            if control_type == asi.ASI_EXPOSURE and np.isfinite(record["exposure"]):
+                return [int(record["exposure"] * 1e6), False]
+            if control_type == asi.ASI_GAIN and np.isfinite(record["gain"]):
+                return [int(record["gain"]), False]
+            if control_type == asi.ASI_TEMPERATURE and np.isfinite(
+                record["temperature"]
+            ):
+                return [int(record["temperature"] * 10), False]
+        return [self.controls.get(control_type, 0), False]
+
+    def start_video_capture(self):
+        self._last_time = None
+
+    def stop_video_capture(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _wait_until(camera, period, timeout):
+    # Sleep until `period` s after the camera's previous frame. Like the SDK,
+    # raise a timeout error instead if that is more than `timeout` ms away
+    # (negative waits forever); the frame is then still pending.
+    now = time.perf_counter()
+    if camera._last_time is None:
+        # Capture (re)started: the exposure starts now
+        camera._last_time = now
+    ready = camera._last_time + period
+    delay = ready - now
+    if 0 <= timeout / 1000 < delay:
+        time.sleep(timeout / 1000)
+        raise asi.ZWO_IOError("Timeout", 11)
+    if delay > 0:
+        time.sleep(delay)
+        camera._last_time = ready
+    else:
+        # Fell behind; don't try to catch up with a burst of frames
+        camera._last_time = now
+
+
+class SimulatedCamera:
+    """
+    Synthetic sensor for load testing, with the zwoasi Camera surface.
+
+    Bias, dark current, hot pixels and read noise are baked into a pool of
+    precomputed frames whenever exposure, gain or binning change, so producing
+    a frame is one copy from the pool plus rendering the moving Gaussian spots
+    into small cutouts. Frames are left-justified to 16 bits like ZWO RAW16.
+    """
+
+    def __init__(
+        self,
+        width=1280,
+        height=960,
+        bins=1,
+        bit_depth=12,
+        bias=100,  # ADU
+        read_noise=3.0,  # e-
+        dark_current=0.05,  # e-/s/pixel
+        hot_pixel_fraction=1e-4,
+        hot_pixel_current=500.0,  # e-/s
+        electrons_per_adu=4.0,  # at gain 0
+        spots=None,
+        pool_size=16,
+        realtime=False,
+        seed=None,
+    ):
+        self.max_width = width
+        self.max_height = height
+        self.bins = bins
+        self.bit_depth = bit_depth
+        self.bias = bias
+        self.read_noise = read_noise
+        self.dark_current = dark_current
+        self.hot_pixel_current = hot_pixel_current
+        self.electrons_per_adu_gain0 = electrons_per_adu
+        self.pool_size = pool_size
+        self.realtime = realtime
+        self.default_timeout = -1
+        self.rng = np.random.default_rng(seed)
+
+        # Hot pixels are fixed in sensor coordinates
+        n_hot = int(hot_pixel_fraction * width * height)
+        self.hot_pixels = (
+            self.rng.integers(0, height, n_hot),
+            self.rng.integers(0, width, n_hot),
+        )
+
+        # Spots in unbinned sensor pixels: position, velocity (px/frame),
+        # width (sigma, px) and flux (e-/s)
+        if spots is None:
+            spots = [
+                dict(x=width / 2, y=height / 2, vx=0.05, vy=0.02, sigma=3.0, flux=2e5)
+            ]
+        self.spots = [dict(spot) for spot in spots]
+
+        self.controls = {
+            asi.ASI_GAIN: 0,
+            asi.ASI_EXPOSURE: 100000,
+            asi.ASI_TEMPERATURE: 200,
+        }
+        # Hardware ROI, in binned pixels like zwoasi (None is the full sensor)
+        self.start_x = 0
+        self.start_y = 0
+        self.roi_size = None
+        self.frames_served = 0
+        self._pool = None
+        self._last_time = None  # When the previous frame was delivered
+
+    @property
+    def exposure(self):
+        return self.controls[asi.ASI_EXPOSURE] / 1e6
+
+    @property
+    def electrons_per_adu(self):
+        # ZWO gain is in units of 0.1 dB
+        return self.electrons_per_adu_gain0 / 10 ** (self.controls[asi.ASI_GAIN] / 200)
+
+    @property
+    def shape(self):
+        if self.roi_size is not None:
+            return (self.roi_size[1], self.roi_size[0])
+        return (self.max_height // self.bins, self.max_width // self.bins)
+
+    def _build_pool(self):
+        # Precompute bias + dark + hot pixels + read noise frames, in ADU
+        shape = self.shape
+        pixels_per_bin = self.bins**2
+        shift = 16 - self.bit_depth
+        max_adu = 2**self.bit_depth - 1
+
+        dark = np.full(shape, self.dark_current * self.exposure * pixels_per_bin)
+        hot_y = self.hot_pixels[0] // self.bins - self.start_y
+        hot_x = self.hot_pixels[1] // self.bins - self.start_x
+        keep = (hot_y >= 0) & (hot_y < shape[0]) & (hot_x >= 0) & (hot_x < shape[1])
+        dark[hot_y[keep], hot_x[keep]] += self.hot_pixel_current * self.exposure
+        base = self.bias + dark / self.electrons_per_adu
+
+        # Read noise plus dark shot noise, in ADU
+        sigma = np.sqrt(self.read_noise**2 * pixels_per_bin + dark).astype(np.float32)
+        sigma /= self.electrons_per_adu
+
+        self._pool = np.empty((self.pool_size, *shape), dtype=np.uint16)
+        noisy = np.empty(shape, dtype=np.float32)
+        for frame in self._pool:
+            self.rng.standard_normal(shape, dtype=np.float32, out=noisy)
+            noisy *= sigma
+            noisy += base
+            np.clip(noisy, 0, max_adu, out=noisy)
+            np.copyto(frame, noisy, casting="unsafe")
+            frame <<= shift
+
+    def _render_spots(self, frame):
+        # Add each spot (with photon noise) into a cutout around it
+        shift = 16 - self.bit_depth
+        max_adu = 2**self.bit_depth - 1
+        height, width = frame.shape
+        for spot in self.spots:
+            # Move the spot, bouncing off the sensor edges
+            for pos, vel, size in (("x", "vx", self.max_width), ("y", "vy", self.max_height)):
+                spot[pos] += spot[vel]
+                if not 0 <= spot[pos] < size:
+                    spot[vel] = -spot[vel]
+                    spot[pos] = min(max(spot[pos], 0), size - 1)
+
+            # Position within the frame, in binned pixels
+            cx = spot["x"] / self.bins - self.start_x
+            cy = spot["y"] / self.bins - self.start_y
+            sigma = spot["sigma"] / self.bins
+            r = int(np.ceil(4 * sigma))
+            x0, x1 = max(int(np.floor(cx)) - r, 0), min(int(np.floor(cx)) + r + 1, width)
+            y0, y1 = max(int(np.floor(cy)) - r, 0), min(int(np.floor(cy)) + r + 1, height)
+            if x0 >= x1 or y0 >= y1:
+                continue
+
+            gx = np.exp(-0.5 * ((np.arange(x0, x1) + 0.5 - cx) / sigma) ** 2)
+            gy = np.exp(-0.5 * ((np.arange(y0, y1) + 0.5 - cy) / sigma) ** 2)
+            electrons = spot["flux"] * self.exposure / (2 * np.pi * sigma**2)
+            signal = self.rng.poisson(np.outer(gy, gx) * electrons)
+
+            cutout = frame[y0:y1, x0:x1]
+            adu = (cutout >> shift) + signal / self.electrons_per_adu
+            np.clip(adu, 0, max_adu, out=adu)
+            cutout[...] = adu.astype(np.uint16) << shift
+
+    def _wait(self, timeout):
+        # Deliver frames at the exposure rate when in real-time mode
+        if not self.realtime:
+            return
+        _wait_until(self, self.exposure, timeout)
+
+    def capture_video_frame(self, buffer_=None, filename=None, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        if self._pool is None:
+            self._build_pool()
+        self._wait(timeout)
+
+        if buffer_ is not None:
+            # Fill the supplied buffer like zwoasi does
+            frame = np.frombuffer(buffer_, dtype=np.uint16).reshape(self.shape)
+        else:
+            frame = np.empty(self.shape, dtype=np.uint16)
+        np.copyto(frame, self._pool[self.rng.integers(self.pool_size)])
+        self._render_spots(frame)
+        self.frames_served += 1
+        return frame
+
+    def get_roi_format(self):
+        height, width = self.shape
+        return [width, height, self.bins, asi.ASI_IMG_RAW16]
+
+    def get_roi_start_position(self):
+        return [self.start_x, self.start_y]
+
+    def set_roi(
+        self, start_x=None, start_y=None, width=None, height=None, bins=None, image_type=None
+    ):
+        # Same rules as zwoasi: binned coordinates, width a multiple of 8,
+        # height a multiple of 2 and None for the full (centred) sensor
+        bins = self.bins if bins is None else bins
+        if bins not in (1, 2, 4):
+            raise ValueError("Illegal value for bins")
+        max_width = self.max_width // bins
+        max_height = self.max_height // bins
+        width = max_width - max_width % 8 if width is None else width
+        height = max_height - max_height % 2 if height is None else height
+        if width % 8 or height % 2:
+            raise ValueError("ROI width must be a multiple of 8 and height of 2")
+        start_x = (max_width - width) // 2 if start_x is None else start_x
+        start_y = (max_height - height) // 2 if start_y is None else start_y
+        if start_x + width > max_width or start_y + height > max_height:
+            raise ValueError("ROI and start position larger than binned sensor")
+
+        self.bins = bins
+        self.start_x = start_x
+        self.start_y = start_y
+        self.roi_size = (width, height)
+        self._pool = None
+
+    def get_camera_property(self):
+        return {
+            "MaxWidth": self.max_width,
+            "MaxHeight": self.max_height,
+            "BitDepth": self.bit_depth,
+            "ElecPerADU": self.electrons_per_adu,
+            "PixelSize": 3.75,
+            "SupportedBins": [1, 2, 4],
+        }
+
+    def set_control_value(self, control_type, value, auto=False):
+        if self.controls.get(control_type) != value:
+            self.controls[control_type] = value
+            if control_type in (asi.ASI_EXPOSURE, asi.ASI_GAIN):
+                # Rebuilt on the next capture, so rapid changes coalesce
+                self._pool = None
+
+    def get_control_value(self, control_type):
+        return [self.controls.get(control_type, 0), False]
+
+    def start_video_capture(self):
+        self._last_time = None
+
+    def stop_video_capture(self):
+        pass
+
+    def close(self):
+        pass
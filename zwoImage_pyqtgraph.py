@@ -1,12 +1,28 @@
 import sys
+import time
+import argparse
+import threading
+import tempfile
 import numpy as np
-from PySide6.QtWidgets import QApplication, QLabel, QSlider, QVBoxLayout, QComboBox, QCheckBox, QWidget, QLineEdit, QHBoxLayout
+import os
+from PySide6.QtWidgets import QApplication, QLabel, QSlider, QVBoxLayout, QComboBox, QCheckBox, QWidget, QLineEdit, QHBoxLayout, QPushButton, QProgressBar
 from PySide6.QtCore import Qt, QTimer, QPoint, QRect, QSize, QThread, Signal
 from PySide6.QtGui import QImage, QPixmap, QPainter, QPen
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtGui
 import zwoasi as asi
 
+from frameBuffer import FrameRecord, FrameRingBuffer, LATEST_ONLY, DROP_OLDEST
+from imgAnalysis import ROIMask, IntegralImage, FrameHistogram, SpotTracker, TRACK_CENTROID, TRACK_GAUSSIAN
+from statWorkers import StatsWorkerPool
+from frameRecorder import FrameRecorder
+from virtualCameras import ReplayCamera, SimulatedCamera
+from frameTiming import FrameTimer
+from timeSeries import TimeSeriesBuffer, DecimationPyramid
+from frameStacking import FrameStacker, STACK_CUMULATIVE, STACK_WINDOW, STACK_EMA
+from calibration import CalibrationLibrary, Calibrator, MASTER_DARK, MASTER_FLAT
+from pixelCleaning import PixelCleaner, hot_pixel_map
+
 # You will have to change this to direct it on your system
 try:
     asi.init(r"C:\Users\bantz\OneDrive - University of Iowa\Work\Diffractometer\cameraControl\ASI SDK\lib\x64\ASICamera2.dll")
@@ -15,20 +31,236 @@ except Exception as e:
 
 
 class FrameCaptureThread(QThread):
-    frame_captured = Signal(
-        np.ndarray
-    )  # Signal emitted with the new frame (as a NumPy array)
-
-    def __init__(self, camera, parent=None):
+    # Signal emitted when new frames are waiting in the ring buffer. It is only
+    # emitted again once the GUI has acknowledged it, so events never pile up.
+    frame_captured = Signal()
+    # Control values confirmed by the camera after being applied,
+    # {control type: value}
+    controls_applied = Signal(object)
+    # Progress of the exposure being waited for: (elapsed, exposure) in s
+    exposure_progress = Signal(float, float)
+
+    # Longest single wait for a frame (ms). Waiting in short steps keeps stop
+    # requests and setting changes prompt even during very long exposures.
+    CAPTURE_WAIT_MS = 50
+
+    def __init__(
+        self, camera, ring_depth=4, ring_mode=LATEST_ONLY, zero_copy=True, parent=None
+    ):
         super().__init__(parent)
         self.camera = camera
         self.running = True
+        # Frames are handed to the GUI through a fixed-depth ring buffer
+        self.ring = FrameRingBuffer(depth=ring_depth, mode=ring_mode)
+        # Capture straight into the ring slots instead of allocating a new
+        # array per frame. Frames are stored in sensor (row, column) order,
+        # the GUI transposes them with a view.
+        self.zero_copy = zero_copy
+
+        # Optional recorder streaming every captured frame to disk
+        self.recorder = None
+        # Camera state recorded with each frame, set by the GUI
+        self.exposure = 0.1
+        self.gain = 0
+        self.temperature = float("nan")
+        self.last_temperature_time = 0
+
+        # Per-stage timestamps of each frame, shared with the GUI
+        self.timer = FrameTimer()
+        self.frame_seq = 0
+
+        # Sensor origin (unbinned pixels) and binning of the frames
+        self.frame_geometry = (0, 0, 1)
+
+        # Camera settings requested by the GUI, applied between frames. Only
+        # the latest value of each is kept, so a dragged slider costs one SDK
+        # call per frame rather than one per tick.
+        self.commands = {}
+        self.commands_lock = threading.Lock()
+        # When the exposure now being waited for started (perf_counter)
+        self.exposure_start = time.perf_counter()
+
+    def sensor_shape(self):
+        # Shape of the frames the camera is currently set up to deliver
+        width, height = self.camera.get_roi_format()[:2]
+        return (height, width)
+
+    def read_geometry(self):
+        # Origin and binning of the frames the camera is set up to deliver.
+        # The SDK start position is in binned pixels.
+        bins = self.camera.get_roi_format()[2]
+        try:
+            start_x, start_y = self.camera.get_roi_start_position()
+        except AttributeError:
+            start_x = start_y = 0
+        return (start_x * bins, start_y * bins, bins)
+
+    def set_control(self, control_type, value):
+        # Queue a control value (an asi.ASI_* control, or "roi" with
+        # (start_x, start_y, width, height, bins) in binned pixels as for
+        # zwoasi's set_roi), replacing any not yet applied
+        with self.commands_lock:
+            self.commands[control_type] = value
+
+    def pending(self, control_type):
+        # Whether a newer value of a control is queued, not yet applied
+        with self.commands_lock:
+            return control_type in self.commands
+
+    def apply_commands(self):
+        # Apply the queued settings and publish what the camera reports back
+        with self.commands_lock:
+            commands = self.commands
+            self.commands = {}
+        roi = commands.pop("roi", None)
+        if roi is not None:
+            self.apply_roi(roi)
+
+        confirmed = {}
+        for control_type, value in commands.items():
+            self.camera.set_control_value(control_type, value)
+            confirmed[control_type] = self.camera.get_control_value(control_type)[0]
+        if asi.ASI_EXPOSURE in confirmed:
+            self.exposure = confirmed[asi.ASI_EXPOSURE] / 1e6
+        if asi.ASI_GAIN in confirmed:
+            self.gain = confirmed[asi.ASI_GAIN]
+        if asi.ASI_EXPOSURE in confirmed or asi.ASI_GAIN in confirmed:
+            # Abandon the exposure in progress (possibly a long one) and any
+            # frame buffered in the SDK, both taken at the old settings, so
+            # no frame is tagged with settings it wasn't taken with
+            self.restart_capture()
+        if confirmed:
+            self.controls_applied.emit(confirmed)
+
+    def restart_capture(self):
+        self.camera.stop_video_capture()
+        self.camera.start_video_capture()
+        self.exposure_start = time.perf_counter()
+
+    def apply_roi(self, roi):
+        # Capture has to be stopped while the ROI format changes
+        try:
+            self.camera.stop_video_capture()
+            self.camera.set_roi(*roi)
+        except (AttributeError, ValueError) as e:
+            print(f"Could not set the camera ROI {roi}: {e}")
+        finally:
+            self.camera.start_video_capture()
+            self.exposure_start = time.perf_counter()
+        self.frame_geometry = self.read_geometry()
+        if self.zero_copy:
+            self.ring.resize(self.sensor_shape())
+
+    def read_temperature(self):
+        # Sensor temperature in C, read at most once a second
+        now = time.perf_counter()
+        if now - self.last_temperature_time >= 1:
+            self.last_temperature_time = now
+            try:
+                self.temperature = (
+                    self.camera.get_control_value(asi.ASI_TEMPERATURE)[0] / 10
+                )
+            except AttributeError:
+                pass
+        return self.temperature
+
+    def tag(self, record, seq):
+        # Stamp a captured frame with the camera state it was taken with
+        record.seq = seq
+        record.timestamp = time.time()
+        record.exposure = self.exposure
+        record.gain = self.gain
+        record.temperature = self.read_temperature()
+        record.geometry = self.frame_geometry
+
+    def record(self, record):
+        # Hand the raw frame to the recorder; this never blocks on disk I/O
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.write(
+                record.data,
+                record.timestamp,
+                record.exposure,
+                record.gain,
+                record.temperature,
+            )
+
+    def wait_for_frame(self, index):
+        """
+        Wait up to CAPTURE_WAIT_MS for the next frame, into ring slot `index`
+        when capturing zero-copy. Returns the frame, or None on a timeout.
+        """
+        try:
+            if self.zero_copy:
+                return self.camera.capture_video_frame(
+                    buffer_=self.ring.buffers[index], timeout=self.CAPTURE_WAIT_MS
+                )
+            return self.camera.capture_video_frame(timeout=self.CAPTURE_WAIT_MS)
+        except asi.ZWO_IOError as e:
+            if e.error_code != 11:  # ASI_ERROR_TIMEOUT
+                raise
+            return None
 
     def run(self):
+        # Start from the camera's actual settings
+        confirmed = {
+            control_type: self.camera.get_control_value(control_type)[0]
+            for control_type in (asi.ASI_EXPOSURE, asi.ASI_GAIN)
+        }
+        self.exposure = confirmed[asi.ASI_EXPOSURE] / 1e6
+        self.gain = confirmed[asi.ASI_GAIN]
+        self.controls_applied.emit(confirmed)
+        self.frame_geometry = self.read_geometry()
+        if self.zero_copy:
+            self.ring.resize(self.sensor_shape())
+        self.exposure_start = time.perf_counter()
+
+        index = None  # Ring slot claimed for the frame being exposed
+        seq = None  # Its sequence number
         while self.running:
-            frame = self.camera.capture_video_frame().T
-            if frame is not None:
-                self.frame_captured.emit(frame)  # Emit the new frame
+            if self.commands:
+                # Settings may resize the ring, so give back the claimed slot
+                if index is not None:
+                    self.ring.abort(index)
+                    index = None
+                seq = None
+                self.apply_commands()
+            if seq is None:
+                seq = self.frame_seq
+                self.frame_seq += 1
+                self.timer.start(seq)
+            if self.zero_copy and index is None:
+                index, record = self.ring.claim()
+
+            try:
+                frame = self.wait_for_frame(index)
+            except Exception:
+                if index is not None:
+                    self.ring.abort(index)
+                raise
+            if frame is None:
+                # Still exposing: report progress and check for new commands.
+                # The claimed slot is kept for when the frame arrives.
+                self.exposure_progress.emit(
+                    time.perf_counter() - self.exposure_start, self.exposure
+                )
+                continue
+            self.exposure_start = time.perf_counter()
+
+            if not self.zero_copy:
+                if frame.shape != self.ring.shape:
+                    self.ring.resize(frame.shape)
+                index, record = self.ring.claim()
+                np.copyto(record.data, frame)
+            self.timer.mark(seq, "captured")
+            self.tag(record, seq)
+            self.record(record)
+            notify = self.ring.commit(index)
+            index = None
+            seq = None
+
+            if notify:
+                self.frame_captured.emit()  # Notify the GUI of the new frame
 
     def stop(self):
         self.running = False
@@ -47,22 +279,104 @@ class CameraControlGUI(QWidget):
         self.pixel_size = 1
         self.sensor_width_pix = 1
         self.sensor_height_pix = 1
+        self.supported_bins = [1]
+        # Sensor origin (unbinned pixels) and binning of the current frame.
+        # ROIs are drawn in unbinned sensor pixels.
+        self.frame_geometry = (0, 0, 1)
+        self.displayed_geometry = None
+        self.requested_roi = None
         self.exposure = 0.1  # seconds
-        self.plot_list = []
+        self.display_rate = 30  # Hz
+        self.histogram_rate = 5  # Hz
+        # Net counts history for the plot, a fixed-size buffer of samples
+        # timed by frame capture and shown over a sliding window
+        self.history = TimeSeriesBuffer(capacity=100000)
+        self.history_window = 60.0  # seconds
+        self.history_start = None
+        self.history_pending = False
+        # The whole history is also kept on disk at several resolutions for
+        # scrolling back
+        self.history_pyramid = None
+        # Optional live co-adding of frames. The stack restarts whenever the
+        # exposure, gain or camera ROI changes.
+        self.stacker = None
+        self.stack_key = None
+        # Dark and flat calibration, and the stack of frames being captured
+        # for a new master frame
+        self.calibration_library = None
+        self.calibrator = None
+        self.calibration_kind = None
+        self.calibration_count = 0
+        self.calibration_frames = []
+        self.calibration_settings = None
+        # Optional hot-pixel and cosmic-ray rejection
+        self.pixel_cleaner = None
+        self.cleaning_key = None
+        # Optional spot tracking: position and FWHM histories (sensor pixels),
+        # plotted as drift from the first position, and a CSV log
+        self.spot_tracker = None
+        self.spot = None  # (time, x, y, FWHM x, FWHM y) of the latest frame
+        # Spots of frames whose statistics haven't been applied yet, by
+        # sequence number, so each log row pairs a spot with its own frame's
+        # net counts even when the statistics come back later from workers
+        self.spot_rows = {}
+        self.spot_origin = None
+        self.spot_x = TimeSeriesBuffer(capacity=100000)
+        self.spot_y = TimeSeriesBuffer(capacity=100000)
+        self.spot_fwhm = TimeSeriesBuffer(capacity=100000)
+        self.spot_pending = False
+        self.spot_log = None
 
         self.update_camera_properties()
         self.division_factor = 2 ** (16 - self.bit_depth)
+        self.bit_shift = 16 - self.bit_depth
 
         # Set up the GUI layout
         self.init_ui()
 
         self.frame_capture_thread = FrameCaptureThread(self.camera)
+        self.frame_capture_thread.exposure = self.exposure
+        self.frame_capture_thread.gain = self.gain_slider.value()
+        self.frame_timer = self.frame_capture_thread.timer
+        self.last_timing_time = 0
         self.frame_capture_thread.frame_captured.connect(self.on_frame_captured)
+        self.frame_capture_thread.controls_applied.connect(self.on_controls_applied)
+        self.frame_capture_thread.exposure_progress.connect(self.on_exposure_progress)
         self.frame_capture_thread.start()
 
         # Set up variables
         self.frame = None
+        self.record = FrameRecord()  # Metadata of the current frame
+        self.frame_count = 0
         self.rect_roi_mean = 0
+        self.histogram = None
+
+        # The display is refreshed at its own rate, independent of the camera.
+        # Statistics still run on every frame.
+        self.display_pending = False
+        self.last_display_time = 0
+        # The ImageItem keeps a reference to its image and renders it later
+        # (and again whenever the levels change), so it is given a GUI-owned
+        # copy rather than the ring slot or a reused processing buffer
+        self.display_frame = None
+        self.display_timer = QTimer(self)
+        self.display_timer.timeout.connect(self.refresh_display)
+        self.display_timer.start(int(1000 / self.display_rate))
+
+        # The HistogramLUT histogram is computed by its own stage, at a lower
+        # rate than the display and from a subsample of the frame
+        self.histogram_stage = FrameHistogram(
+            stride=4, max_value=65535 // self.division_factor
+        )
+        self.last_histogram_time = 0
+        self.histogram_timer = QTimer(self)
+        self.histogram_timer.timeout.connect(self.update_histogram)
+        self.histogram_timer.start(int(1000 / self.histogram_rate))
+
+        # Optional process pool for the ROI statistics and histogram
+        self.stats_pool = None
+        self.worker_timer = QTimer(self)
+        self.worker_timer.timeout.connect(self.collect_worker_statistics)
 
         # Timer for updating camera frames
         # self.timer = QTimer(self)
@@ -70,14 +384,23 @@ class CameraControlGUI(QWidget):
         # self.timer.start(33)  # Update every ~33ms (~30 fps)
 
     def update_camera_properties(self):
+        try:
+            camera_props = self.camera.get_camera_property()
+            self.sensor_width_pix = camera_props["MaxWidth"]
+            self.sensor_height_pix = camera_props["MaxHeight"]
+            self.supported_bins = camera_props.get("SupportedBins", [1])
+        except AttributeError:
+            width, height, bins = self.camera.get_roi_format()[:3]
+            self.sensor_width_pix = width * bins
+            self.sensor_height_pix = height * bins
+            self.supported_bins = [bins]
+
         # camera_props = self.camera.get_camera_property()
         # print(f"Gain is now {self.camera.get_control_value(asi.ASI_GAIN)[0]}")
 
         # self.bit_depth = camera_props["BitDepth"]
         # self.electron_per_adu = camera_props["ElecPerADU"]
         # self.pixel_size = camera_props["PixelSize"]
-        # self.sensor_width_pix = camera_props["MaxWidth"]
-        # self.sensor_height_pix = camera_props["MaxHeight"]
 
         try:
             self.camera_prop_bit_depth.setText(f"Bit Depth: {self.bit_depth}")
@@ -128,6 +451,13 @@ class CameraControlGUI(QWidget):
         exposure_layout.addWidget(self.exposure_label)
         exposure_layout.addWidget(self.exposure_input)
 
+        # Progress of the exposure in progress, for long exposures
+        self.exposure_progress_bar = QProgressBar()
+        self.exposure_progress_bar.setRange(0, 1000)
+        self.exposure_progress_bar.setFixedWidth(150)
+        self.exposure_progress_bar.setFormat("")
+        exposure_layout.addWidget(self.exposure_progress_bar)
+
         layout.addLayout(exposure_layout)
 
         # Add h layout for gain slider and line
@@ -159,6 +489,12 @@ class CameraControlGUI(QWidget):
         self.image_view = pg.ImageView(self)
         layout.addWidget(self.image_view)
 
+        # Stop pyqtgraph recomputing the full-frame histogram on every image
+        # change; update_histogram feeds the histogram plot instead
+        self.image_view.getImageItem().sigImageChanged.disconnect(
+            self.image_view.getHistogramWidget().item.imageChanged
+        )
+
         # self.image_view.getHistogramWidget().disableAutoHistogramRange()
         self.image_view.getHistogramWidget().setHistogramRange(
             0, 65535 / self.division_factor
@@ -175,6 +511,14 @@ class CameraControlGUI(QWidget):
         self.image_view.getView().setRange(xRange=[0, self.sensor_width_pix])
         self.image_view.getView().setRange(yRange=[0, self.sensor_height_pix])
 
+        # Overlay label for the pipeline timing, drawn over the image
+        self.timing_label = QLabel(self.image_view)
+        self.timing_label.setStyleSheet(
+            "background-color: rgba(0, 0, 0, 160); color: white; font-family: monospace;"
+        )
+        self.timing_label.move(10, 10)
+        self.timing_label.hide()
+
         # Add circle ROI to the image view
         self.circle_ROI = pg.CircleROI([100, 100], [50, 50], pen=(4, 9))
         self.image_view.addItem(self.circle_ROI)
@@ -183,6 +527,21 @@ class CameraControlGUI(QWidget):
         self.rect_ROI = pg.RectROI([50, 100], [50, 50], pen=(5, 1))
         self.image_view.addItem(self.rect_ROI)
 
+        # Pixel masks for the ROI statistics, rebuilt only when an ROI moves
+        self.circle_mask = ROIMask(elliptical=True)
+        self.rect_mask = ROIMask()
+        self.circle_ROI.sigRegionChanged.connect(self.update_ROI_masks)
+        self.rect_ROI.sigRegionChanged.connect(self.update_ROI_masks)
+        # The hardware ROI follows the ROIs once they are dropped
+        self.circle_ROI.sigRegionChangeFinished.connect(self.update_hardware_ROI)
+        self.rect_ROI.sigRegionChangeFinished.connect(self.update_hardware_ROI)
+        # Additional rectangle ROIs (Bragg peaks, background boxes). With many
+        # of them the summed-area table backend keeps the cost flat.
+        self.extra_rect_ROIs = []
+        self.extra_rect_masks = []
+        self.integral_image = IntegralImage()
+        self.update_ROI_masks()
+
         # Add horizontal layout for statistics labels
         stats_layout = QHBoxLayout()
 
@@ -199,11 +558,38 @@ class CameraControlGUI(QWidget):
         circle_ROI_layout.addWidget(self.circle_ROI_sum)
         self.circle_ROI_mean = QLabel("Mean: ")
         circle_ROI_layout.addWidget(self.circle_ROI_mean)
+        self.circle_ROI_std = QLabel("Std: ")
+        circle_ROI_layout.addWidget(self.circle_ROI_std)
+        self.circle_ROI_min_max = QLabel("Min/Max: ")
+        circle_ROI_layout.addWidget(self.circle_ROI_min_max)
+        self.circle_ROI_pixels = QLabel("Pixels: ")
+        circle_ROI_layout.addWidget(self.circle_ROI_pixels)
         self.circle_ROI_net_counts = QLabel("Net Counts: ")
         self.circle_ROI_net_counts_checkbox = QCheckBox("Plot net?")
         self.circle_ROI_net_counts_checkbox.stateChanged.connect(self.reset_plot)
         circle_ROI_layout.addWidget(self.circle_ROI_net_counts_checkbox)
         circle_ROI_layout.addWidget(self.circle_ROI_net_counts)
+        # Hot-pixel and cosmic-ray rejection, and how many pixels it replaced
+        self.cleaning_checkbox = QCheckBox("Clean pixels")
+        self.cleaning_checkbox.stateChanged.connect(self.toggle_cleaning)
+        circle_ROI_layout.addWidget(self.cleaning_checkbox)
+        self.cleaned_label = QLabel("")
+        circle_ROI_layout.addWidget(self.cleaned_label)
+        # Spot tracking within a window around the circle ROI, optionally
+        # moving the ROI with the spot
+        tracking_layout = QHBoxLayout()
+        self.tracking_checkbox = QCheckBox("Track")
+        self.tracking_checkbox.stateChanged.connect(self.toggle_tracking)
+        tracking_layout.addWidget(self.tracking_checkbox)
+        self.tracking_method_selector = QComboBox(self)
+        self.tracking_method_selector.addItems(["Centroid", "Gaussian"])
+        self.tracking_method_selector.currentTextChanged.connect(self.update_tracking_method)
+        tracking_layout.addWidget(self.tracking_method_selector)
+        self.follow_checkbox = QCheckBox("Follow")
+        tracking_layout.addWidget(self.follow_checkbox)
+        circle_ROI_layout.addLayout(tracking_layout)
+        self.spot_label = QLabel("")
+        circle_ROI_layout.addWidget(self.spot_label)
 
         # Add the Circle ROI layout to the stats layout
         stats_layout.addLayout(circle_ROI_layout)
@@ -220,6 +606,20 @@ class CameraControlGUI(QWidget):
         rect_ROI_layout.addWidget(self.rect_ROI_sum)
         self.rect_ROI_mean = QLabel("Mean: ")
         rect_ROI_layout.addWidget(self.rect_ROI_mean)
+        self.rect_ROI_std = QLabel("Std: ")
+        rect_ROI_layout.addWidget(self.rect_ROI_std)
+        self.rect_ROI_min_max = QLabel("Min/Max: ")
+        rect_ROI_layout.addWidget(self.rect_ROI_min_max)
+        # Button to add more rectangle ROIs, and their statistics
+        self.add_rect_ROI_button = QPushButton("Add Rect ROI")
+        self.add_rect_ROI_button.clicked.connect(self.add_rect_ROI)
+        rect_ROI_layout.addWidget(self.add_rect_ROI_button)
+        # Checkbox to compute rectangle ROIs from a summed-area table, when
+        # that is faster than their masks
+        self.integral_checkbox = QCheckBox("Integral image (auto)")
+        rect_ROI_layout.addWidget(self.integral_checkbox)
+        self.extra_ROI_label = QLabel("")
+        rect_ROI_layout.addWidget(self.extra_ROI_label)
 
         # Add the Rectangle ROI layout to the stats layout
         stats_layout.addLayout(rect_ROI_layout)
@@ -247,6 +647,117 @@ class CameraControlGUI(QWidget):
         # On state change, reset plot
         self.rate_checkbox.stateChanged.connect(self.reset_plot)
         camera_prop_layout.addWidget(self.rate_checkbox)
+        # Frame buffer mode and delivered/dropped frame counters
+        self.ring_mode_selector = QComboBox(self)
+        self.ring_mode_selector.addItems(["Latest only", "Drop oldest"])
+        self.ring_mode_selector.currentTextChanged.connect(self.update_ring_mode)
+        camera_prop_layout.addWidget(self.ring_mode_selector)
+        # Hardware ROI around the on-screen ROIs, and binning
+        hardware_ROI_layout = QHBoxLayout()
+        self.hardware_ROI_checkbox = QCheckBox("HW ROI")
+        self.hardware_ROI_checkbox.stateChanged.connect(self.update_hardware_ROI)
+        hardware_ROI_layout.addWidget(self.hardware_ROI_checkbox)
+        hardware_ROI_layout.addWidget(QLabel("Bin"))
+        self.bin_selector = QComboBox(self)
+        self.bin_selector.addItems([str(bins) for bins in self.supported_bins])
+        self.bin_selector.setCurrentText(str(self.camera.get_roi_format()[2]))
+        self.bin_selector.currentTextChanged.connect(self.update_hardware_ROI)
+        hardware_ROI_layout.addWidget(self.bin_selector)
+        camera_prop_layout.addLayout(hardware_ROI_layout)
+        self.frame_counter_label = QLabel("Frames: ")
+        camera_prop_layout.addWidget(self.frame_counter_label)
+        # Display refresh rate input
+        display_rate_layout = QHBoxLayout()
+        display_rate_layout.addWidget(QLabel("Display Hz"))
+        self.display_rate_input = QLineEdit(str(self.display_rate))
+        self.display_rate_input.setFixedWidth(50)
+        self.display_rate_input.returnPressed.connect(self.update_display_rate)
+        display_rate_layout.addWidget(self.display_rate_input)
+        camera_prop_layout.addLayout(display_rate_layout)
+        # Histogram update rate and subsampling stride
+        histogram_layout = QHBoxLayout()
+        histogram_layout.addWidget(QLabel("Hist Hz"))
+        self.histogram_rate_input = QLineEdit(str(self.histogram_rate))
+        self.histogram_rate_input.setFixedWidth(40)
+        self.histogram_rate_input.returnPressed.connect(self.update_histogram_settings)
+        histogram_layout.addWidget(self.histogram_rate_input)
+        histogram_layout.addWidget(QLabel("Stride"))
+        self.histogram_stride_input = QLineEdit("4")
+        self.histogram_stride_input.setFixedWidth(40)
+        self.histogram_stride_input.returnPressed.connect(self.update_histogram_settings)
+        histogram_layout.addWidget(self.histogram_stride_input)
+        camera_prop_layout.addLayout(histogram_layout)
+        # Time span of the net counts plot
+        history_layout = QHBoxLayout()
+        history_layout.addWidget(QLabel("Plot window (s)"))
+        self.history_window_input = QLineEdit(str(self.history_window))
+        self.history_window_input.setFixedWidth(50)
+        self.history_window_input.returnPressed.connect(self.update_history_window)
+        history_layout.addWidget(self.history_window_input)
+        camera_prop_layout.addLayout(history_layout)
+        # Frame stacking mode and length (window frames or EMA span)
+        stack_layout = QHBoxLayout()
+        stack_layout.addWidget(QLabel("Stack"))
+        self.stack_selector = QComboBox(self)
+        self.stack_selector.addItems(["Off", "Cumulative", "Window", "EMA"])
+        self.stack_selector.currentTextChanged.connect(self.update_stacking)
+        stack_layout.addWidget(self.stack_selector)
+        stack_layout.addWidget(QLabel("N"))
+        self.stack_length_input = QLineEdit("16")
+        self.stack_length_input.setFixedWidth(40)
+        self.stack_length_input.returnPressed.connect(self.update_stacking)
+        stack_layout.addWidget(self.stack_length_input)
+        camera_prop_layout.addLayout(stack_layout)
+        # Show and analyse the stacked image instead of the raw frame
+        stack_view_layout = QHBoxLayout()
+        self.show_stacked_checkbox = QCheckBox("Show stacked")
+        stack_view_layout.addWidget(self.show_stacked_checkbox)
+        self.reset_stack_button = QPushButton("Reset")
+        self.reset_stack_button.clicked.connect(self.reset_stack)
+        stack_view_layout.addWidget(self.reset_stack_button)
+        camera_prop_layout.addLayout(stack_view_layout)
+        self.stack_label = QLabel("")
+        camera_prop_layout.addWidget(self.stack_label)
+        # Dark/flat calibration, and capture of frames for new master frames
+        calibration_layout = QHBoxLayout()
+        self.calibration_checkbox = QCheckBox("Calibrate")
+        self.calibration_checkbox.stateChanged.connect(self.toggle_calibration)
+        calibration_layout.addWidget(self.calibration_checkbox)
+        self.capture_darks_button = QPushButton("Darks")
+        self.capture_darks_button.clicked.connect(
+            lambda: self.start_calibration_capture(MASTER_DARK)
+        )
+        calibration_layout.addWidget(self.capture_darks_button)
+        self.capture_flats_button = QPushButton("Flats")
+        self.capture_flats_button.clicked.connect(
+            lambda: self.start_calibration_capture(MASTER_FLAT)
+        )
+        calibration_layout.addWidget(self.capture_flats_button)
+        calibration_layout.addWidget(QLabel("N"))
+        self.calibration_count_input = QLineEdit("16")
+        self.calibration_count_input.setFixedWidth(40)
+        calibration_layout.addWidget(self.calibration_count_input)
+        camera_prop_layout.addLayout(calibration_layout)
+        self.calibration_label = QLabel("")
+        camera_prop_layout.addWidget(self.calibration_label)
+        # Record button and recorder status
+        self.record_button = QPushButton("Record")
+        self.record_button.setCheckable(True)
+        self.record_button.toggled.connect(self.toggle_recording)
+        camera_prop_layout.addWidget(self.record_button)
+        self.record_label = QLabel("")
+        camera_prop_layout.addWidget(self.record_label)
+        # Timing overlay and export
+        self.timing_checkbox = QCheckBox("Timing overlay")
+        self.timing_checkbox.stateChanged.connect(self.toggle_timing_overlay)
+        camera_prop_layout.addWidget(self.timing_checkbox)
+        self.export_timing_button = QPushButton("Export Timing")
+        self.export_timing_button.clicked.connect(self.export_timing)
+        camera_prop_layout.addWidget(self.export_timing_button)
+        # Checkbox to run the statistics in worker processes
+        self.worker_checkbox = QCheckBox("Worker stats")
+        self.worker_checkbox.stateChanged.connect(self.toggle_worker_statistics)
+        camera_prop_layout.addWidget(self.worker_checkbox)
 
         # Add the camera properties layout to the stats layout
         stats_layout.addLayout(camera_prop_layout)
@@ -259,12 +770,39 @@ class CameraControlGUI(QWidget):
         self.plot.setTitle("Previous Measurements")
         self.plot.showGrid(x=True, y=True)
         self.plot.addLegend()
+        # One curve, updated in place. Peak downsampling and clipping to the
+        # visible range keep redraws flat however many samples are shown.
+        self.history_curve = self.plot.plot(pen=(255, 0, 0), name="Net Counts")
+        self.history_curve.setDownsampling(auto=True, method="peak")
+        self.history_curve.setClipToView(True)
+        # Panning or zooming away from the live view browses the full history
+        self.plot.getPlotItem().sigXRangeChanged.connect(self.browse_history)
         # self.plot.setLimits(xMin=0, xMax=10, yMin=0, yMax=100)
         self.plot.setFixedHeight(200)
         self.plot.setFixedWidth(500)
         # Add the plot to the stats layout
         stats_layout.addWidget(self.plot)
 
+        # Second plot for the tracked spot: drift from where tracking started,
+        # and FWHM, in sensor pixels
+        self.spot_plot = pg.PlotWidget()
+        self.spot_plot.setLabel("bottom", "Time", units="s")
+        self.spot_plot.setLabel("left", "Pixels")
+        self.spot_plot.setTitle("Spot Position and FWHM")
+        self.spot_plot.showGrid(x=True, y=True)
+        self.spot_plot.addLegend()
+        self.spot_curves = [
+            self.spot_plot.plot(pen=pen, name=name)
+            for pen, name in (((255, 0, 0), "dx"), ((0, 255, 0), "dy"), ((0, 128, 255), "FWHM"))
+        ]
+        for curve in self.spot_curves:
+            curve.setDownsampling(auto=True, method="peak")
+            curve.setClipToView(True)
+        self.spot_plot.setFixedHeight(200)
+        self.spot_plot.setFixedWidth(500)
+        self.spot_plot.hide()
+        stats_layout.addWidget(self.spot_plot)
+
         # Add the stats layout to the main layout
         layout.addLayout(stats_layout)
 
@@ -279,8 +817,65 @@ class CameraControlGUI(QWidget):
 
     def reset_plot(self):
         # Reset the plot
-        self.plot.clear()
-        self.plot_list = []
+        self.history.clear()
+        self.history_start = None
+        self.history_curve.setData([], [])
+        if self.history_pyramid is not None:
+            self.history_pyramid.close()
+            self.history_pyramid = None
+        # The next history goes to a new pyramid, made with its first sample
+
+    def new_history_pyramid(self):
+        # A new, uniquely named directory for each history, so histories
+        # started within the same second (e.g. counts, then rates after
+        # toggling Calculate Rate) are never appended to one another
+        os.makedirs("recordings", exist_ok=True)
+        path = tempfile.mkdtemp(
+            prefix=time.strftime("History_%Y%m%d_%H%M%S_"), dir="recordings"
+        )
+        return DecimationPyramid(path)
+
+    def update_history_plot(self):
+        # Show the samples within the plot window, in seconds since the first.
+        # Once the user pans or zooms the plot, browse_history takes over until
+        # auto range is turned back on.
+        self.history_pending = False
+        if not self.plot.getViewBox().autoRangeEnabled()[0]:
+            return
+        times, values = self.history.data(self.history_window)
+        self.history_curve.setData(times - self.history_start, values)
+
+    def browse_history(self, view_box, x_range):
+        # Draw the visible time range from the history pyramid level with about
+        # one record per pixel, as a min/max envelope when decimated
+        if self.history_pyramid is None or self.history_start is None:
+            return
+        if self.plot.getViewBox().autoRangeEnabled()[0]:
+            return
+        origin = self.history_start
+        level, records = self.history_pyramid.query(
+            x_range[0] + origin, x_range[1] + origin, max_points=self.plot.width()
+        )
+        times = records["time"] - origin
+        if level == 0:
+            self.history_curve.setData(times, records["mean"])
+        else:
+            self.history_curve.setData(
+                np.repeat(times, 2),
+                np.column_stack([records["min"], records["max"]]).ravel(),
+            )
+
+    def update_history_window(self):
+        # Read the plot time window from the input box
+        try:
+            value = float(self.history_window_input.text())
+            if value > 0:
+                self.history_window = value
+                self.history_pending = True
+            else:
+                print("Invalid plot window!")
+        except ValueError:
+            print("Please enter a valid number!")
 
     def update_exposure_from_slider(self, value):
         # Update the exposure time based on the slider's value
@@ -310,49 +905,523 @@ class CameraControlGUI(QWidget):
         except ValueError:
             print("Please enter a valid number!")
 
-    def on_frame_captured(self, frame):
-        self.frame = frame // self.division_factor
-        current_view_range = self.image_view.getView().viewRange()
-        # print(f"Current view range: {current_view_range}")
-        # current_histogram_range = self.image_view.getHistogramWidget().getLevels()
-        # print(f"Current histogram range: {current_histogram_range}")
-        current_histogram_view_range = (
-            self.image_view.getHistogramWidget().getHistogramRange()
+    def on_frame_captured(self):
+        # Drain the ring buffer. In latest-only mode there is at most one frame,
+        # in drop-oldest mode the buffered frames are processed in order. The
+        # drain is bounded by the ring depth so a fast camera can't starve the GUI.
+        ring = self.frame_capture_thread.ring
+        ring.acknowledge()
+        for _ in range(ring.depth):
+            record = ring.pop()
+            if record is None:
+                break
+            self.frame_timer.mark(record.seq, "dequeued")
+            self.process_frame(record)
+
+        # Apply any statistics the worker processes have finished
+        self.collect_worker_statistics()
+
+        # The display timer can be starved while frames keep arriving, so also
+        # refresh from here once a display period has passed
+        if time.perf_counter() - self.last_display_time >= 1 / self.display_rate:
+            self.refresh_display()
+        if time.perf_counter() - self.last_histogram_time >= 1 / self.histogram_rate:
+            self.update_histogram()
+        if self.timing_label.isVisible() and time.perf_counter() - self.last_timing_time >= 0.5:
+            self.update_timing_overlay()
+
+        self.frame_counter_label.setText(
+            f"Frames: {ring.delivered} shown, {ring.dropped} dropped"
         )
-        # print(f"Current histogram view range: {current_histogram_view_range}")
+        if self.stacker is not None:
+            self.stack_label.setText(f"Stacked: {self.stacker.count} frames")
+        cleaner = self.pixel_cleaner
+        if cleaner is not None and cleaner.replaced is not None:
+            # The replaced-pixel map is in sensor order, the ROIs are transposed
+            in_circle = np.count_nonzero(self.circle_mask.pixels(cleaner.replaced.T))
+            self.cleaned_label.setText(
+                f"Cleaned: {cleaner.hot_replaced} hot, {cleaner.outliers_replaced} hits"
+                f" ({in_circle} in circle)"
+            )
+        if self.spot_tracker is not None:
+            if self.spot is None:
+                self.spot_label.setText("Spot: not found")
+            else:
+                _, x, y, fwhm_x, fwhm_y = self.spot
+                self.spot_label.setText(
+                    f"Spot: ({x:.2f}, {y:.2f}) px, FWHM {fwhm_x:.2f} x {fwhm_y:.2f} px"
+                )
+        if self.calibrator is not None and self.calibration_kind is None:
+            self.calibration_label.setText(
+                f"Dark: {'yes' if self.calibrator.dark is not None else 'none'}, "
+                f"flat: {'yes' if self.calibrator.inverse_flat is not None else 'none'}"
+            )
+        recorder = self.frame_capture_thread.recorder
+        if recorder is not None:
+            self.record_label.setText(
+                f"Rec: {recorder.throughput():.1f} MB/s, "
+                f"{recorder.frames_written} frames, {recorder.dropped} dropped"
+            )
+
+    def update_ring_mode(self, text):
+        # Switch the frame buffer between latest-only and drop-oldest
+        mode = LATEST_ONLY if text == "Latest only" else DROP_OLDEST
+        self.frame_capture_thread.ring.set_mode(mode)
+
+    def process_frame(self, record):
+        # The leased ring slot belongs to the GUI until the next pop, so the
+        # bit-depth shift is done in place and the transpose is just a view.
+        # The display copies the frame out before the slot is given back.
+        self.record = record
+        if record.geometry != self.frame_geometry:
+            # The camera ROI or binning changed, move the masks with it
+            self.frame_geometry = record.geometry
+            self.update_ROI_masks()
+        frame = record.data
+        if self.bit_shift:
+            np.right_shift(frame, self.bit_shift, out=frame)
+        if self.calibration_kind is not None:
+            self.capture_calibration_frame(record)
+        if self.calibrator is not None:
+            # Dark-subtracted and flat-fielded copy, in a reused buffer
+            frame = self.calibrator.apply(frame, record)
+        if self.pixel_cleaner is not None:
+            self.clean_frame(frame, record)
+        self.frame = frame.T
+        if self.stacker is not None:
+            self.stack_frame(record)
+        if self.spot_tracker is not None:
+            self.track_spot(record)
+        self.frame_count += 1
+        self.frame_timer.mark(record.seq, "processed")
 
         # Add 30000 count square to the frame
         # self.frame[100:200, 100:200] += 1000
-        # Update the image view with the new frame
-        self.image_view.setImage(self.frame, autoLevels=False)
-        # Restore the previous view range
-        self.image_view.getView().setRange(
-            xRange=current_view_range[0], yRange=current_view_range[1], padding=0
-        )
-        # Restore the previous histogram view range
-        self.image_view.getHistogramWidget().setHistogramRange(
-            *current_histogram_view_range, padding=0
-        )
+        # The image view picks up the newest frame on the next display refresh
+        self.display_pending = True
+
+        if self.stats_pool is not None:
+            # Statistics are computed by the worker pool and applied when ready
+            self.submit_worker_statistics()
+            return
 
         # Update the statistics for the rectangle ROI
         self.update_rect_ROI_statistics()
 
         # Update the statistics for the circle ROI
         self.update_circle_ROI_statistics()
+        self.frame_timer.mark(record.seq, "stats")
+
+    def stack_frame(self, record):
+        # Add the frame to the stack, and show and analyse the stacked mean
+        # instead of the frame if asked to
+        key = (record.exposure, record.gain, record.geometry)
+        if key != self.stack_key:
+            # Frames taken with other settings aren't mixed into the stack
+            self.stack_key = key
+            self.stacker.reset()
+        stacked = self.stacker.update(self.frame)
+        if self.show_stacked_checkbox.isChecked():
+            self.frame = stacked
+
+    def update_stacking(self, *args):
+        # Start a new stack with the selected mode and length
+        modes = {"Cumulative": STACK_CUMULATIVE, "Window": STACK_WINDOW, "EMA": STACK_EMA}
+        mode = modes.get(self.stack_selector.currentText())
+        if mode is None:
+            self.stacker = None
+            self.stack_label.setText("")
+            return
+        try:
+            length = int(self.stack_length_input.text())
+            if length < 1:
+                raise ValueError
+        except ValueError:
+            print("Please enter a whole number of frames to stack!")
+            return
+        self.stacker = FrameStacker(mode, length=length)
+        self.stack_key = None
+
+    def reset_stack(self):
+        if self.stacker is not None:
+            self.stacker.reset()
+
+    def get_calibration_library(self):
+        if self.calibration_library is None:
+            self.calibration_library = CalibrationLibrary("calibration")
+        return self.calibration_library
+
+    def toggle_calibration(self, state):
+        if self.calibration_checkbox.isChecked():
+            self.calibrator = Calibrator(self.get_calibration_library())
+        else:
+            self.calibrator = None
+            self.calibration_label.setText("")
+
+    def start_calibration_capture(self, kind):
+        # Collect the next N raw frames for a master dark or flat
+        try:
+            count = int(self.calibration_count_input.text())
+            if count < 1:
+                raise ValueError
+        except ValueError:
+            print("Please enter a whole number of calibration frames!")
+            return
+        self.calibration_kind = kind
+        self.calibration_count = count
+        self.calibration_frames = []
+        self.calibration_label.setText(f"Capturing {kind}s: 0/{count}")
+
+    def capture_calibration_frame(self, record):
+        settings = (record.exposure, record.gain, record.geometry)
+        first = self.calibration_settings
+        if self.calibration_frames and settings != (first.exposure, first.gain, first.geometry):
+            print("Camera settings changed, restarting the calibration capture")
+            self.calibration_frames = []
+        if not self.calibration_frames:
+            self.calibration_settings = record.metadata()
+        self.calibration_frames.append(record.data.copy())
+        kind = self.calibration_kind
+        count = len(self.calibration_frames)
+        self.calibration_label.setText(
+            f"Capturing {kind}s: {count}/{self.calibration_count}"
+        )
+        if count < self.calibration_count:
+            return
+
+        # Combine the stack into a master and cache it on disk
+        frames = self.calibration_frames
+        self.calibration_kind = None
+        self.calibration_frames = []
+        library = self.get_calibration_library()
+        build = library.build_dark if kind == MASTER_DARK else library.build_flat
+        first = self.calibration_settings
+        try:
+            entry = build(frames, first.exposure, first.gain, first.temperature, first.geometry)
+        except ValueError as e:
+            print(e)
+            self.calibration_label.setText("")
+            return
+        print(f"Saved master {kind} of {count} frames to {entry['file']}")
+        self.calibration_label.setText(f"Master {kind}: {entry['file']}")
+        if self.calibrator is not None:
+            self.calibrator.refresh()
+
+    def toggle_cleaning(self, state):
+        if self.cleaning_checkbox.isChecked():
+            self.pixel_cleaner = PixelCleaner()
+            self.cleaning_key = None
+        else:
+            if self.pixel_cleaner is not None:
+                self.pixel_cleaner.close()
+            self.pixel_cleaner = None
+            self.cleaned_label.setText("")
+
+    def clean_frame(self, frame, record):
+        # Replace hot pixels and cosmic-ray hits in the frame, in place. The
+        # static hot pixels are those of the master dark for the frame's
+        # settings, if there is one.
+        key = (record.exposure, record.gain, record.geometry, frame.shape)
+        if key != self.cleaning_key:
+            self.cleaning_key = key
+            self.pixel_cleaner.reset()
+            dark = self.get_calibration_library().find_dark(
+                record.exposure, record.gain, record.temperature, record.geometry, frame.shape
+            )
+            self.pixel_cleaner.set_hot_pixels(None if dark is None else hot_pixel_map(dark))
+        self.pixel_cleaner.clean(frame)
+
+    def toggle_tracking(self, state):
+        # Start or stop tracking, with a fresh history and log
+        if self.spot_log is not None:
+            self.spot_log.close()
+            self.spot_log = None
+        self.spot = None
+        self.spot_origin = None
+        self.spot_rows.clear()
+        for series in (self.spot_x, self.spot_y, self.spot_fwhm):
+            series.clear()
+        if not self.tracking_checkbox.isChecked():
+            self.spot_tracker = None
+            self.spot_label.setText("")
+            self.spot_plot.hide()
+            return
+        self.spot_tracker = SpotTracker()
+        self.update_tracking_method()
+        os.makedirs("recordings", exist_ok=True)
+        path = os.path.join("recordings", time.strftime("Spot_%Y%m%d_%H%M%S.csv"))
+        self.spot_log = open(path, "w")
+        self.spot_log.write("time,x,y,fwhm_x,fwhm_y,net_counts\n")
+        self.spot_plot.show()
+
+    def update_tracking_method(self, *args):
+        if self.spot_tracker is not None:
+            gaussian = self.tracking_method_selector.currentText() == "Gaussian"
+            self.spot_tracker.method = TRACK_GAUSSIAN if gaussian else TRACK_CENTROID
+
+    def track_spot(self, record):
+        # Locate the spot in a window twice the size of the circle ROI around
+        # it. The tracker works in frame pixels, the ROI and the histories in
+        # sensor pixels.
+        x0, y0, bins = self.frame_geometry
+        pos, size = self.circle_ROI.pos(), self.circle_ROI.size()
+        center_x = pos[0] + size[0] / 2
+        center_y = pos[1] + size[1] / 2
+        fit = self.spot_tracker.locate(
+            self.frame, ((center_x - x0) / bins, (center_y - y0) / bins), size[0] / bins
+        )
+        if fit is None:
+            self.spot = None
+            return
+        x = x0 + fit.x * bins
+        y = y0 + fit.y * bins
+        self.spot = (record.timestamp, x, y, fit.fwhm_x * bins, fit.fwhm_y * bins)
+        if self.spot_log is not None:
+            self.spot_rows[record.seq] = self.spot
+        if self.spot_origin is None:
+            self.spot_origin = self.spot
+        self.spot_x.append(record.timestamp, x)
+        self.spot_y.append(record.timestamp, y)
+        self.spot_fwhm.append(record.timestamp, (fit.fwhm_x + fit.fwhm_y) / 2 * bins)
+        self.spot_pending = True
+
+        if self.follow_checkbox.isChecked():
+            # Recentre the circle ROI on the spot, ignoring sub-pixel jitter.
+            # The hardware ROI is left where it is.
+            dx = x - center_x
+            dy = y - center_y
+            if abs(dx) > 0.1 * bins or abs(dy) > 0.1 * bins:
+                self.circle_ROI.setPos([pos[0] + dx, pos[1] + dy], finish=False)
+
+    def update_spot_plot(self):
+        # Drift and FWHM over the plot window, in seconds since tracking began
+        self.spot_pending = False
+        origin_time, origin_x, origin_y = self.spot_origin[:3]
+        for curve, series, offset in zip(
+            self.spot_curves,
+            (self.spot_x, self.spot_y, self.spot_fwhm),
+            (origin_x, origin_y, 0),
+        ):
+            times, values = series.data(self.history_window)
+            curve.setData(times - origin_time, values - offset)
+
+    def refresh_display(self):
+        # Show the newest frame, if there is one we haven't shown yet
+        if not self.display_pending:
+            return
+        self.display_pending = False
+        self.last_display_time = time.perf_counter()
+
+        if (
+            self.display_frame is None
+            or self.display_frame.shape != self.frame.shape
+            or self.display_frame.dtype != self.frame.dtype
+        ):
+            # Same memory order as the frame, so the copy is one memcpy
+            self.display_frame = np.empty_like(self.frame)
+        np.copyto(self.display_frame, self.frame)
+
+        image_item = self.image_view.getImageItem()
+        if (
+            image_item.image is None
+            or image_item.image.shape != self.frame.shape
+            or self.displayed_geometry != self.frame_geometry
+        ):
+            # First frame (or new frame size or camera ROI): let the ImageView
+            # set itself up, placing the frame at its sensor position
+            x0, y0, bins = self.frame_geometry
+            self.image_view.setImage(
+                self.display_frame,
+                autoLevels=False,
+                autoRange=image_item.image is None,
+                autoHistogramRange=False,
+                pos=(x0, y0),
+                scale=(bins, bins),
+            )
+            self.displayed_geometry = self.frame_geometry
+        else:
+            # Only swap the image data, skipping ImageView's auto-range and
+            # histogram range bookkeeping, so the view range is left alone
+            image_item.updateImage(self.display_frame)
+        self.frame_timer.mark(self.record.seq, "displayed")
+
+        if self.history_pending:
+            self.update_history_plot()
+        if self.spot_pending:
+            self.update_spot_plot()
+
+    def update_display_rate(self):
+        # Read the display refresh rate from the input box
+        try:
+            value = float(self.display_rate_input.text())
+            if 0 < value <= 240:
+                self.display_rate = value
+                self.display_timer.start(int(1000 / value))
+            else:
+                print("Invalid display rate!")
+        except ValueError:
+            print("Please enter a valid number!")
+
+    def toggle_timing_overlay(self, state):
+        self.timing_label.setVisible(self.timing_checkbox.isChecked())
+        self.update_timing_overlay()
+
+    def update_timing_overlay(self):
+        # Live fps, per-stage latency percentiles and dropped frame counts
+        self.last_timing_time = time.perf_counter()
+        text = self.frame_timer.summary()
+        text += f"\nDropped: {self.frame_capture_thread.ring.dropped} (ring)"
+        recorder = self.frame_capture_thread.recorder
+        if recorder is not None:
+            text += f", {recorder.dropped} (recorder)"
+        if self.stats_pool is not None:
+            text += f", {self.stats_pool.skipped} (workers)"
+        self.timing_label.setText(text)
+        self.timing_label.adjustSize()
+
+    def export_timing(self):
+        # Save the per-frame stage timestamps to CSV
+        os.makedirs("recordings", exist_ok=True)
+        path = os.path.join("recordings", time.strftime("Timing_%Y%m%d_%H%M%S.csv"))
+        self.frame_timer.export_csv(path)
+        print(f"Saved timing to {path}")
+
+    def toggle_recording(self, checked):
+        # Start or stop streaming raw frames to disk
+        if checked:
+            os.makedirs("recordings", exist_ok=True)
+            path = os.path.join(
+                "recordings", time.strftime("Record_%Y%m%d_%H%M%S")
+            )
+            print(f"Recording to {path}")
+            shape = self.frame_capture_thread.ring.shape
+            if shape is None:
+                print("No frames captured yet, can't record!")
+                self.record_button.setChecked(False)
+                return
+            self.frame_capture_thread.recorder = FrameRecorder(
+                path, shape, bit_depth=self.bit_depth
+            )
+            self.record_button.setText("Stop")
+        else:
+            recorder = self.frame_capture_thread.recorder
+            self.frame_capture_thread.recorder = None
+            if recorder is not None:
+                recorder.close()
+                print(
+                    f"Recorded {recorder.frames_written} frames "
+                    f"({recorder.dropped} dropped) to {recorder.path}"
+                )
+            self.record_button.setText("Record")
+
+    def update_histogram(self):
+        # Refresh the HistogramLUT histogram from the newest frame. With the
+        # worker pool running, its histograms are used instead.
+        if self.frame is None:
+            return
+        self.last_histogram_time = time.perf_counter()
+        if self.stats_pool is None:
+            self.histogram = self.histogram_stage.update(self.frame)
+        if self.histogram is not None:
+            self.image_view.getHistogramWidget().item.plot.setData(*self.histogram)
+
+    def update_histogram_settings(self):
+        # Read the histogram rate and stride from the input boxes
+        try:
+            rate = float(self.histogram_rate_input.text())
+            stride = int(self.histogram_stride_input.text())
+            if 0 < rate <= 60 and stride >= 1:
+                self.histogram_rate = rate
+                self.histogram_stage.stride = stride
+                self.histogram_timer.start(int(1000 / rate))
+                if self.stats_pool is not None:
+                    self.stats_pool.hist_stride = stride
+            else:
+                print("Invalid histogram settings!")
+        except ValueError:
+            print("Please enter a valid number!")
+
+    def toggle_worker_statistics(self, state):
+        # Start or stop the statistics worker pool
+        if self.worker_checkbox.isChecked():
+            self.stats_pool = StatsWorkerPool(hist_stride=self.histogram_stage.stride)
+            self.worker_timer.start(20)
+        elif self.stats_pool is not None:
+            self.worker_timer.stop()
+            self.stats_pool.close()
+            self.stats_pool = None
+
+    def submit_worker_statistics(self):
+        # Send the frame and ROI geometry (rectangles first, circle last)
+        masks = [self.rect_mask] + self.extra_rect_masks + [self.circle_mask]
+        rois = [(mask.elliptical, mask.pos, mask.size) for mask in masks]
+        self.stats_pool.submit(
+            self.frame,
+            rois,
+            info=self.record.metadata(),
+            integral=self.integral_checkbox.isChecked(),
+            max_value=65535 >> self.bit_shift,
+        )
+
+    def collect_worker_statistics(self):
+        if self.stats_pool is None:
+            return
+        for result in self.stats_pool.results():
+            self.update_rect_ROI_statistics(result.roi_stats[:-1], result.frame)
+            self.update_circle_ROI_statistics(result.roi_stats[-1], result.frame)
+            self.histogram = result.histogram
 
     def update_exposure(self, value):
-        # Update the camera's exposure time
-        value = value
-        print(f"Updating exposure to {value}")
-        timeout = (value * 1000) * 4 + 500
-        print(f"Setting timeout to {timeout} ms")
-        self.camera.default_timeout = timeout
+        # Update the camera's exposure time. The capture thread applies it
+        # between frames (with the capture timeout) and reports it back.
         print(f"Updating exposure to {value} sec")
-        # Example: self.camera.set_exposure(value)
-        self.camera.set_control_value(asi.ASI_EXPOSURE, int(value * 1e6))
-        # Print the current exposure value
-        self.exposure = self.camera.get_control_value(asi.ASI_EXPOSURE)[0] / 1e6
-        print(f"Current exposure: {self.exposure} sec")
+        self.frame_capture_thread.set_control(asi.ASI_EXPOSURE, int(value * 1e6))
+
+    def on_exposure_progress(self, elapsed, exposure):
+        # Sent by the capture thread while it waits for a frame
+        fraction = min(elapsed / exposure, 1) if exposure > 0 else 1
+        self.exposure_progress_bar.setValue(int(fraction * 1000))
+        self.exposure_progress_bar.setFormat(f"{elapsed:.1f} / {exposure:.1f} s")
+
+    def on_controls_applied(self, confirmed):
+        # Control values the camera has confirmed. The widgets are set to
+        # them, as the camera may have clamped the requested value (or a
+        # replay reports the recorded one), unless a newer value is on its
+        # way or the slider is still being dragged.
+        thread = self.frame_capture_thread
+        if asi.ASI_EXPOSURE in confirmed:
+            self.exposure = confirmed[asi.ASI_EXPOSURE] / 1e6
+            print(f"Current exposure: {self.exposure} sec")
+            if not thread.pending(asi.ASI_EXPOSURE) and not self.exposure_slider.isSliderDown():
+                # Round halves up (round() would take 0.05 s to 0), within
+                # the slider's range
+                position = int(self.exposure * 10 + 0.5)
+                position = min(
+                    max(position, self.exposure_slider.minimum()),
+                    self.exposure_slider.maximum(),
+                )
+                self.show_control_value(
+                    self.exposure_slider, self.exposure_input, position, self.exposure
+                )
+                self.exposure_label.setText(f"Exposure: {self.exposure}")
+        if asi.ASI_GAIN in confirmed:
+            gain = confirmed[asi.ASI_GAIN]
+            print(f"Current gain: {gain}")
+            if not thread.pending(asi.ASI_GAIN) and not self.gain_slider.isSliderDown():
+                position = min(max(gain, self.gain_slider.minimum()), self.gain_slider.maximum())
+                self.show_control_value(self.gain_slider, self.gain_input, position, gain)
+            # Update camera properties
+            self.update_camera_properties()
+
+    def show_control_value(self, slider, input_box, position, value):
+        # Show a value on a slider and its input box without requesting it
+        # from the camera again
+        slider.blockSignals(True)
+        input_box.blockSignals(True)
+        slider.setValue(position)
+        input_box.setText(str(value))
+        slider.blockSignals(False)
+        input_box.blockSignals(False)
 
     # def update_shape_selection(self, shape):
     #     self.camera_label.set_shape(shape)
@@ -379,57 +1448,170 @@ class CameraControlGUI(QWidget):
     def update_gain(self, value):
         # Update the camera's gain based on the input value
         print(f"Updating gain to {value}")
-        # Example: self.camera.set_gain(value)
-        self.camera.set_control_value(asi.ASI_GAIN, value)
-        # Update camera properties
-        self.update_camera_properties()
-
-    def update_rect_ROI_statistics(self):
-        # Update the statistics for the rectangle ROI
-        # Get average in the rectangle ROI
-        rect_roi_mask = self.rect_ROI.getArrayRegion(
-            self.frame, self.image_view.getImageItem()
+        # Applied by the capture thread between frames
+        self.frame_capture_thread.set_control(asi.ASI_GAIN, value)
+
+    def update_ROI_masks(self):
+        # Called when an ROI is moved or resized. The masks rebuild lazily on
+        # the next frame, so dragging an ROI costs nothing per drag event.
+        # ROIs are in sensor pixels, masks in the (sub)frame's binned pixels.
+        x0, y0, bins = self.frame_geometry
+        rois = [self.circle_ROI, self.rect_ROI] + self.extra_rect_ROIs
+        masks = [self.circle_mask, self.rect_mask] + self.extra_rect_masks
+        for roi, mask in zip(rois, masks):
+            pos, size = roi.pos(), roi.size()
+            mask.set_geometry(
+                ((pos[0] - x0) / bins, (pos[1] - y0) / bins),
+                (size[0] / bins, size[1] / bins),
+            )
+
+    def hardware_ROI(self):
+        # Camera ROI (start x, start y, width, height, bins in binned pixels)
+        # covering every on-screen ROI plus a margin, or the whole sensor
+        bins = int(self.bin_selector.currentText())
+        max_width = self.sensor_width_pix // bins
+        max_height = self.sensor_height_pix // bins
+        full_width = max_width - max_width % 8
+        full_height = max_height - max_height % 2
+        if not self.hardware_ROI_checkbox.isChecked():
+            return (0, 0, full_width, full_height, bins)
+
+        margin = 16  # sensor pixels
+        rois = [self.circle_ROI, self.rect_ROI] + self.extra_rect_ROIs
+        x0 = min(roi.pos()[0] for roi in rois) - margin
+        y0 = min(roi.pos()[1] for roi in rois) - margin
+        x1 = max(roi.pos()[0] + roi.size()[0] for roi in rois) + margin
+        y1 = max(roi.pos()[1] + roi.size()[1] for roi in rois) + margin
+
+        # Round outwards to binned pixels, then up to the SDK's multiples of
+        # 8 (width) and 2 (height), keeping the ROI on the sensor
+        x0 = min(max(int(np.floor(x0 / bins)), 0), max_width)
+        y0 = min(max(int(np.floor(y0 / bins)), 0), max_height)
+        x1 = min(max(int(np.ceil(x1 / bins)), x0 + 1), max_width)
+        y1 = min(max(int(np.ceil(y1 / bins)), y0 + 1), max_height)
+        width = min(-(-(x1 - x0) // 8) * 8, full_width)
+        height = min(-(-(y1 - y0) // 2) * 2, full_height)
+        x0 = min(x0, max_width - width)
+        y0 = min(y0, max_height - height)
+        return (x0, y0, width, height, bins)
+
+    def update_hardware_ROI(self, *args):
+        # Ask the capture thread to switch the camera ROI, if it changed
+        roi = self.hardware_ROI()
+        if (
+            self.requested_roi is None
+            and not self.hardware_ROI_checkbox.isChecked()
+            and roi[4] == self.frame_geometry[2]
+        ):
+            # Leave the camera's own ROI alone until something is asked for
+            return
+        if roi != self.requested_roi:
+            self.requested_roi = roi
+            self.frame_capture_thread.set_control("roi", roi)
+
+    def add_rect_ROI(self):
+        # Add another rectangle ROI next to the existing ones
+        n = len(self.extra_rect_ROIs)
+        roi = pg.RectROI(
+            [50 + 20 * n, 160 + 20 * n], [30, 30], pen=(n + 6, 12), removable=True
         )
-        self.rect_roi_sum = np.sum(rect_roi_mask)
-        self.rect_roi_mean = np.mean(rect_roi_mask)
+        roi.sigRegionChanged.connect(self.update_ROI_masks)
+        roi.sigRegionChangeFinished.connect(self.update_hardware_ROI)
+        roi.sigRemoveRequested.connect(self.remove_rect_ROI)
+        self.image_view.addItem(roi)
+        self.extra_rect_ROIs.append(roi)
+        self.extra_rect_masks.append(ROIMask())
+        self.update_ROI_masks()
+
+    def remove_rect_ROI(self, roi):
+        # Remove an extra rectangle ROI (right click -> Remove ROI)
+        index = self.extra_rect_ROIs.index(roi)
+        self.image_view.removeItem(roi)
+        del self.extra_rect_ROIs[index]
+        del self.extra_rect_masks[index]
+
+    def compute_rect_ROI_statistics(self):
+        # Statistics for the main rectangle ROI followed by the extra rectangles
+        masks = [self.rect_mask] + self.extra_rect_masks
+        if self.integral_checkbox.isChecked():
+            # One pass builds the summed-area tables, each box is then O(1),
+            # but only when that beats the masks for these boxes
+            boxes = [mask.bounds(self.frame.shape) for mask in masks]
+            if IntegralImage.pays_off(boxes, self.frame.shape):
+                self.integral_image.update(self.frame)
+                return self.integral_image.box_stats(boxes)
+        return [mask.stats(self.frame) for mask in masks]
+
+    def update_rect_ROI_statistics(self, all_stats=None, record=None):
+        # Update the statistics for the rectangle ROIs, computing them here
+        # unless they were already computed by the worker pool. Rates use the
+        # exposure the frame was taken with (default: the current frame).
+        if record is None:
+            record = self.record
+        exposure = record.exposure
+        if all_stats is None:
+            all_stats = self.compute_rect_ROI_statistics()
+        stats = all_stats[0]
+        self.rect_roi_sum = stats.sum
+        self.rect_roi_mean = stats.mean
+        rect_roi_std = stats.std
+        rect_roi_min, rect_roi_max = stats.min, stats.max
         # print(f"Rectangle ROI mean: {self.rect_roi_mean:.4g}")
 
         if self.electron_per_adu_checkbox.isChecked():
             # Convert counts to electrons using the camera's e-/ADU value
             self.rect_roi_sum *= self.electron_per_adu
             self.rect_roi_mean *= self.electron_per_adu
+            rect_roi_std *= self.electron_per_adu
+            rect_roi_min *= self.electron_per_adu
+            rect_roi_max *= self.electron_per_adu
             units = "e-"  # Electrons
         else:
             units = "counts"
 
         if self.rate_checkbox.isChecked():
             # Calculate the rate
-            self.rect_roi_sum /= self.exposure
-            self.rect_roi_mean /= self.exposure
+            self.rect_roi_sum /= exposure
+            self.rect_roi_mean /= exposure
+            rect_roi_std /= exposure
+            rect_roi_min /= exposure
+            rect_roi_max /= exposure
             rateUnit = "/sec"
         else:
             rateUnit = ""
 
         self.rect_ROI_sum.setText(f"Sum: {self.rect_roi_sum:.3e} {units}{rateUnit}")
         self.rect_ROI_mean.setText(f"Mean: {self.rect_roi_mean:.4g} {units}{rateUnit}")
-
-    def update_circle_ROI_statistics(self):
-        # Update the statistics for the circle ROI
-
-        # Get average in the circle ROI
-        circle_roi_mask = self.circle_ROI.getArrayRegion(
-            self.frame, self.image_view.getImageItem()
+        self.rect_ROI_std.setText(f"Std: {rect_roi_std:.4g} {units}{rateUnit}")
+        self.rect_ROI_min_max.setText(
+            f"Min/Max: {rect_roi_min:.4g} / {rect_roi_max:.4g} {units}{rateUnit}"
         )
-        # Calculate mean of non-0 values in the circle ROI
-        # First calculate sum of all values in the circle ROI
-        circle_roi_sum = np.sum(circle_roi_mask)
-        # print(f"Circle ROI sum: {circle_roi_sum:.3e}")
 
-        # Then find number of non-zero values in the circle ROI
-        num_nonzero = np.sum(circle_roi_mask != 0)
+        # Extra rectangle ROIs, in the same units as the main one
+        scale = self.electron_per_adu if units == "e-" else 1
+        if rateUnit:
+            scale /= exposure
+        self.extra_ROI_label.setText(
+            "\n".join(
+                f"ROI {i + 2}: mean {extra.mean * scale:.4g}, sum {extra.sum * scale:.3e}"
+                for i, extra in enumerate(all_stats[1:])
+            )
+        )
 
-        # Calculate mean of non-zero values in the circle ROI
-        circle_roi_mean = circle_roi_sum / num_nonzero if num_nonzero > 0 else 0
+    def update_circle_ROI_statistics(self, stats=None, record=None):
+        # Update the statistics for the circle ROI of the frame described by
+        # `record` (by default the current frame)
+        if record is None:
+            record = self.record
+        exposure = record.exposure
+        if stats is None:
+            stats = self.circle_mask.stats(self.frame)
+        circle_roi_sum = stats.sum
+        circle_roi_mean = stats.mean
+        circle_roi_std = stats.std
+        circle_roi_min, circle_roi_max = stats.min, stats.max
+        # Number of pixels whose centre lies inside the circle
+        num_pixels = stats.count
         # print(f"Circle ROI mean: {circle_roi_mean:.4g}")
 
         # Calculate net counts in the circle ROI
@@ -438,11 +1620,14 @@ class CameraControlGUI(QWidget):
             # rectangle mean is in e-
             circle_roi_sum *= self.electron_per_adu
             circle_roi_mean *= self.electron_per_adu
+            circle_roi_std *= self.electron_per_adu
+            circle_roi_min *= self.electron_per_adu
+            circle_roi_max *= self.electron_per_adu
             units = "e-"
             # Still not right - rect mean will have units of counts or e- depending on checkbox
-            net_counts = circle_roi_sum - (self.rect_roi_mean * num_nonzero)
+            net_counts = circle_roi_sum - (self.rect_roi_mean * num_pixels)
         else:
-            net_counts = circle_roi_sum - (self.rect_roi_mean * num_nonzero)
+            net_counts = circle_roi_sum - (self.rect_roi_mean * num_pixels)
             units = "counts"
         # print(f"Net counts in circle ROI: {net_counts:.3e}")
 
@@ -457,9 +1642,12 @@ class CameraControlGUI(QWidget):
 
         if self.rate_checkbox.isChecked():
             # Calculate the rate
-            circle_roi_sum /= self.exposure
-            circle_roi_mean /= self.exposure
-            net_counts = circle_roi_sum - (self.rect_roi_mean * num_nonzero)
+            circle_roi_sum /= exposure
+            circle_roi_mean /= exposure
+            circle_roi_std /= exposure
+            circle_roi_min /= exposure
+            circle_roi_max /= exposure
+            net_counts = circle_roi_sum - (self.rect_roi_mean * num_pixels)
             rateUnit = "/sec"
         else:
             rateUnit = ""
@@ -469,14 +1657,36 @@ class CameraControlGUI(QWidget):
         )
         self.circle_ROI_sum.setText(f"Sum: {circle_roi_sum:.3e} {units}{rateUnit}")
         self.circle_ROI_mean.setText(f"Mean: {circle_roi_mean:.4g} {units}{rateUnit}")
+        self.circle_ROI_std.setText(f"Std: {circle_roi_std:.4g} {units}{rateUnit}")
+        self.circle_ROI_min_max.setText(
+            f"Min/Max: {circle_roi_min:.4g} / {circle_roi_max:.4g} {units}{rateUnit}"
+        )
+        self.circle_ROI_pixels.setText(f"Pixels: {num_pixels}")
         self.circle_ROI_net_counts.setText(f"Net: {net_counts:.3e} {units}{rateUnit}")
 
         if self.circle_ROI_net_counts_checkbox.isChecked():
-            # Add the net counts to the plot if the checkbox is checked
-            # at the next time step
-            self.plot_list.append(net_counts)
-            self.plot.clear()
-            self.plot.plot(self.plot_list, pen=(255, 0, 0), name="Net Counts")
+            # Add the net counts to the history, timed by when the frame was
+            # captured. The plot itself is redrawn on the next display refresh.
+            t = record.timestamp
+            if self.history_start is None:
+                self.history_start = t
+            self.history.append(t, net_counts)
+            if self.history_pyramid is None:
+                # Only histories with samples are kept on disk
+                self.history_pyramid = self.new_history_pyramid()
+            self.history_pyramid.append(t, net_counts)
+            self.history_pending = True
+
+        if self.spot_log is not None:
+            # Log this frame's spot alongside its net counts. Spots of older
+            # frames whose statistics never arrived are dropped.
+            spot = self.spot_rows.pop(record.seq, None)
+            for seq in [seq for seq in self.spot_rows if seq < record.seq]:
+                del self.spot_rows[seq]
+            if spot is not None:
+                self.spot_log.write(
+                    "{:.6f},{:.3f},{:.3f},{:.3f},{:.3f},{:.6g}\n".format(*spot, net_counts)
+                )
 
     def closeEvent(self, event):
         """
@@ -485,6 +1695,19 @@ class CameraControlGUI(QWidget):
         print("Closing application...")
         # self.timer.stop()
         self.frame_capture_thread.stop()
+        self.toggle_recording(False)
+        if self.stats_pool is not None:
+            self.stats_pool.close()
+            self.stats_pool = None
+        if self.history_pyramid is not None:
+            self.history_pyramid.close()
+            self.history_pyramid = None
+        if self.pixel_cleaner is not None:
+            self.pixel_cleaner.close()
+            self.pixel_cleaner = None
+        if self.spot_log is not None:
+            self.spot_log.close()
+            self.spot_log = None
         self.camera.stop_video_capture()
         self.camera.close()
         event.accept()
@@ -492,17 +1715,90 @@ class CameraControlGUI(QWidget):
 
 # Dummy camera class for simulation purposes (returns 16-bit mono images)
 class DummyCamera:
-    def capture_video_frame(self):
+    def __init__(self, width=640 * 2, height=480 * 2):
+        self.max_width = width
+        self.max_height = height
+        self.width = width
+        self.height = height
+        self.bins = 1
+        self.start_x = 0
+        self.start_y = 0
+
+        self.controls = {
+            asi.ASI_GAIN: 50,
+            asi.ASI_EXPOSURE: 100000,
+            asi.ASI_TEMPERATURE: 200,
+        }
+
+    def get_roi_format(self):
+        return [self.width, self.height, self.bins, asi.ASI_IMG_RAW16]
+
+    def set_control_value(self, control_type, value, auto=False):
+        self.controls[control_type] = value
+
+    def get_control_value(self, control_type):
+        return [self.controls.get(control_type, 0), False]
+
+    def get_roi_start_position(self):
+        return [self.start_x, self.start_y]
+
+    def set_roi(
+        self, start_x=None, start_y=None, width=None, height=None, bins=None, image_type=None
+    ):
+        # Binned coordinates like zwoasi, None for the full sensor
+        if bins is not None:
+            self.bins = bins
+        self.width = width or self.max_width // self.bins
+        self.height = height or self.max_height // self.bins
+        self.start_x = start_x or 0
+        self.start_y = start_y or 0
+
+    def start_video_capture(self):
+        pass
+
+    def stop_video_capture(self):
+        pass
+
+    def close(self):
+        pass
+
+    def capture_video_frame(self, buffer_=None, filename=None, timeout=None):
         # Simulate a 16-bit grayscale image (480x640)
-        return np.random.randint(0, 65535, (480 * 2, 640 * 2), dtype=np.uint16)
+        frame = np.random.randint(
+            0, 65535, (self.height, self.width), dtype=np.uint16
+        )
+        if buffer_ is not None:
+            # Fill the supplied buffer like zwoasi does
+            out = np.frombuffer(buffer_, dtype=np.uint16).reshape(frame.shape)
+            out[...] = frame
+            return out
+        return frame
 
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     # qdarktheme.setup_theme()
 
+    parser = argparse.ArgumentParser(description="16-bit mono camera control")
+    parser.add_argument(
+        "--replay", help="Play back a .frames recording or a directory of FITS frames"
+    )
+    parser.add_argument(
+        "--fast", action="store_true", help="Replay as fast as possible"
+    )
+    parser.add_argument(
+        "--sim", action="store_true", help="Use the simulated sensor (noise, hot pixels, spots)"
+    )
+    parser.add_argument("--bins", type=int, default=1, help="Binning for --sim")
+    args, _ = parser.parse_known_args()
+
     # Initialize the camera (replace DummyCamera with actual camera class)
-    camera = DummyCamera()
+    if args.replay:
+        camera = ReplayCamera(args.replay, realtime=not args.fast)
+    elif args.sim:
+        camera = SimulatedCamera(bins=args.bins, realtime=not args.fast)
+    else:
+        camera = DummyCamera()
 
     # camera = asi.Camera(0)
     # camera.set_control_value(asi.ASI_GAIN, 50)